@@ -1,14 +1,44 @@
 #!/usr/bin/python
 # coding:utf-8
 
+import base64, json, logging
+
+# 生成不透明的分页游标：方向、排序字段值(created_at)、主键、目标页码
+def encode_cursor(direction, value, primarykey, page_index):
+	s = json.dumps([direction, value, primarykey, page_index], separators=(',', ':'))
+	return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 解析游标，格式不正确时返回None
+# 游标来自客户端，created_at必须是数字、主键必须是字符串，否则伪造的列表、字典会作为参数传给数据库
+def decode_cursor(cursor):
+	try:
+		s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+		direction, value, primarykey, page_index = json.loads(s.decode('utf-8'))
+		if direction not in ('next', 'prev') or int(page_index) < 1:
+			return None
+		if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(primarykey, str):
+			logging.info('invalid cursor: %s' % cursor)
+			return None
+		return direction, value, primarykey, int(page_index)
+	except (ValueError, TypeError, UnicodeError):
+		logging.info('invalid cursor: %s' % cursor)
+		return None
+
 class Page(object):
-	def __init__(self, item_count, page_index=1, page_size=10):
+	def __init__(self, item_count, page_index=1, page_size=10, cursor=None):
 		#blog总数量item_count
 		self.item_count = item_count
 		self.page_size = page_size
 		# 计算blog总页数
 		self.page_count = item_count // page_size + \
 							(1 if item_count % page_size > 0 else 0)
+		# 游标分页：seek为(方向, created_at, id)，交给Model.findSeek使用
+		self.seek = None
+		self.next_cursor = None
+		self.prev_cursor = None
+		decoded = decode_cursor(cursor) if cursor else None
+		if decoded:
+			page_index = min(decoded[3], max(self.page_count, 1))
 		if (item_count == 0) or (page_index > self.page_count):
 			self.offset = 0
 			self.limit = 0
@@ -18,9 +48,23 @@ class Page(object):
 			# offset:本页前的blog数量
 			self.offset = self.page_size * (page_index - 1)
 			self.limit = self.page_size
+			if decoded:
+				# 游标模式下不再使用offset
+				self.seek = decoded[:3]
+				self.offset = 0
 		self.has_next = self.page_index < self.page_count
 		self.has_previous = self.page_index > 1
 
+	# 根据本页数据(按created_at倒序)生成上一页、下一页的游标
+	def set_cursors(self, items, key='created_at'):
+		if not items:
+			return
+		first, last = items[0], items[-1]
+		if self.has_next:
+			self.next_cursor = encode_cursor('next', last[key], last['id'], self.page_index + 1)
+		if self.has_previous:
+			self.prev_cursor = encode_cursor('prev', first[key], first['id'], self.page_index - 1)
+
 	def __str__(self):
 		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % \
 					(self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
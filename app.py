@@ -1,9 +1,10 @@
 #!/usr/bin/python
 # coding:utf-8
 
-import asyncio, os, json, time, logging
-import orm
+import asyncio, os, json, time, logging, random, math
+import orm, images, serializers
 from config import configs
+from models import User, Blog, Comment
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
@@ -67,6 +68,75 @@ async def logger_factory(app, handler):
 		return await handler(request)
 	return logger
 
+# N+1查询检测：记录每个请求执行的查询，同一语句形式的次数达到threshold时报告
+# mode为'dev'时每个请求都记录，在响应头中返回查询次数并把重复的查询写入日志
+# mode为'prod'时按sample_rate抽样，计入orm.query_stats的请求统计(见/api/stats/queries)
+async def query_trace_factory(app, handler):
+	conf = configs['query_trace']
+	async def query_trace(request):
+		dev = conf['mode'] == 'dev'
+		if not dev and random.random() >= conf['sample_rate']:
+			return await handler(request)
+		with orm.query_trace() as trace:
+			r = await handler(request)
+		repeated = trace.repeated(conf['threshold'])
+		if dev:
+			if repeated:
+				logging.warning('N+1 queries in %s %s: %s' % (request.method, request.path, '; '.join('%s x%s' % (shape, n) for shape, n in repeated)))
+			if isinstance(r, web.StreamResponse) and not r.prepared:
+				r.headers['X-Query-Count'] = str(trace.count)
+				r.headers['X-Query-Time'] = '%.1fms' % (trace.elapsed * 1000)
+				if repeated:
+					r.headers['X-Query-Repeated'] = str(len(repeated))
+		else:
+			resource = getattr(request.match_info.route, 'resource', None)
+			route = resource.canonical if resource is not None else request.path
+			orm.query_stats.record_request('%s %s' % (request.method, route), trace, repeated)
+		return r
+	return query_trace
+
+# 读自己的写的cookie：请求中有写入时记录写入时间，之后的请求在窗口内仍读主库
+WRITE_COOKIE = 'awelastwrite'
+
+async def read_your_writes_factory(app, handler):
+	async def read_your_writes(request):
+		window = orm.read_your_writes_window()
+		if not window:
+			return await handler(request)
+		try:
+			orm.restore_last_write(float(request.cookies.get(WRITE_COOKIE, '0')))
+		except ValueError:
+			pass
+		before = orm.last_write()
+		r = await handler(request)
+		wrote = orm.last_write()
+		if wrote > before and isinstance(r, web.StreamResponse) and not r.prepared:
+			r.set_cookie(WRITE_COOKIE, '%.3f' % wrote, max_age=math.ceil(window), httponly=True)
+		return r
+	return read_your_writes
+
+# 按路由设置连接池的优先级通道：@get/@post的lane参数，管理页面默认为admin
+async def lane_factory(app, handler):
+	async def lane(request):
+		fn = getattr(request.match_info.handler, '_func', None)
+		name = getattr(fn, '__lane__', None)
+		if name is None and request.path.startswith('/manage/'):
+			name = 'admin'
+		if name is None:
+			return await handler(request)
+		with orm.lane(name):
+			return await handler(request)
+	return lane
+
+# 为每个请求绑定identity map，同一请求内重复的Model.find只查询一次
+async def identity_map_factory(app, handler):
+	async def identity_map(request):
+		with orm.identity_map() as imap:
+			r = await handler(request)
+		logging.info('identity map: %s hits, %s misses' % (imap.hits, imap.misses))
+		return r
+	return identity_map
+
 async def auth_factory(app, handler):
 	async def auth(request):
 		logging.info('check user: %s %s' % (request.method, request.path))
@@ -97,16 +167,18 @@ async def response_factory(app, handler):
 		if isinstance(r, web.StreamResponse): # StreamResponse是所有Response对象的父类
 			return r # 无需构造，直接返回
 
+		# 异步迭代器(如Model.stream())：边迭代边输出
+		if hasattr(r, '__aiter__'):
+			return await stream_response(request, r)
+
 		# r为dict对象时
 		if isinstance(r, dict):
 			# 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
 			template = r.get('__template__', None)
 			# 不带模板信息(后台api)，返回json对象
 			if template is None:
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))
-				# ensure_ascii：默认True，仅能输出ascii格式数据。故设置为False。
-				# default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
-				# __dict__：以dict形式返回对象属性和值的映射
+				# 按类型注册的转换函数处理Page、Row等对象，直接生成utf-8编码的bytes，见serializers.py
+				resp = web.Response(body=serializers.dumps(r))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 
@@ -121,12 +193,64 @@ async def response_factory(app, handler):
 	return response
 
 
+# 上传的图片按内容哈希命名，内容不会变化，允许浏览器和CDN永久缓存
+async def immutable_uploads(request, response):
+	if request.path.startswith(images.UPLOAD_URL):
+		response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+# 流式输出时缓冲的字节数，超过后写出；第一项总是立即写出，尽快返回首字节
+STREAM_FLUSH_SIZE = 16 * 1024
+
+# 把异步迭代器的结果逐项序列化，以分块传输输出为JSON数组，或按Accept/format=ndjson输出为NDJSON(每行一个JSON)
+# write()在发送缓冲区满时等待客户端读取(背压)，内存占用与结果总数无关
+async def stream_response(request, items):
+	ndjson = request.query.get('format', None) == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+	resp = web.StreamResponse()
+	resp.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+	resp.charset = 'utf-8'
+	resp.enable_chunked_encoding()
+	await resp.prepare(request)
+	buf = bytearray() if ndjson else bytearray(b'[')
+	count = 0
+	try:
+		async for item in items:
+			if count and not ndjson:
+				buf += b','
+			buf += serializers.dumps(item)
+			if ndjson:
+				buf += b'\n'
+			count += 1
+			if count == 1 or len(buf) >= STREAM_FLUSH_SIZE:
+				await resp.write(bytes(buf))
+				buf.clear()
+	except Exception:
+		# 响应头已发出，无法再返回错误页面，断开连接让客户端知道数据不完整
+		logging.exception('stream aborted after %s items' % count)
+		raise
+	finally:
+		# 客户端断开或出错时立即关闭生成器，释放它占用的数据库连接
+		if hasattr(items, 'aclose'):
+			await items.aclose()
+	if not ndjson:
+		buf += b']'
+	await resp.write(bytes(buf))
+	await resp.write_eof()
+	logging.info('streamed %s items' % count)
+	return resp
+
 async def init(loop):
 	await orm.create_pool(loop, **configs['db']) # 添加配置文件
-	app = web.Application(loop = loop, middlewares=[ logger_factory, auth_factory, response_factory])
+	orm.query_cache.configure(**configs['cache'])
+	orm.query_stats.configure(**configs['query_stats'])
+	serializers.use(configs['json']['backend'])
+	# 预先统计各表行数，列表页分页时不再每次count
+	await orm.counters.seed(User, Blog, Comment)
+	orm.counters.start(configs['counters']['reconcile_interval'])
+	app = web.Application(loop = loop, middlewares=[ logger_factory, query_trace_factory, read_your_writes_factory, lane_factory, identity_map_factory, auth_factory, response_factory])
 	init_jinja2(app, filters=dict(datetime = datetime_filter))
 	add_routes(app, 'handler')
 	add_static(app)
+	app.on_response_prepare.append(immutable_uploads)
 	srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
 	logging.info('server started at http://127.0.0.1:9000...')
 	return srv
@@ -3,14 +3,62 @@
 
 configs = {
 	'db':{
+		# 数据库后端：mysql，或单机部署用的sqlite(使用下面的path和readers，忽略其它连接配置)
+		'backend': 'mysql',
+		'path': 'awesome.db',
+		'readers': 4,
 		'host': '127.0.0.1',
 		'port': 3306,
 		'user': 'root',
 		'password': 'maple',
-		'db': 'awesome'
+		'db': 'awesome',
+		# 只读副本，每项只需写出与主库不同的配置，本地测试时可以指向同一MySQL上的其它库，如 {'db': 'awesome_replica1'}
+		'replicas': [],
+		# 写入后多少秒内的读操作仍走主库
+		'read_your_writes': 1,
+		# 合并并发的find调用：window为等待合并的秒数(0为同一事件循环周期内)，size为一条查询最多的主键数
+		'find_batch': True,
+		'find_batch_window': 0,
+		'find_batch_size': 100,
+		# 允许一次发送多条语句，orm.batch()把多条查询合并为一次往返；关闭时batch()退化为依次查询
+		# 开启后连接池的所有连接都接受多条语句，一旦出现SQL注入就可以执行追加的语句，默认关闭
+		'multi_statements': False,
+		# 连接池的优先级通道：reserved为预留给该通道的连接数，weight为争用共享连接时的权重
+		'lanes': {
+			'interactive': {'reserved': 4, 'weight': 4},
+			'admin': {'reserved': 1, 'weight': 2},
+			'batch': {'reserved': 0, 'weight': 1}
+		}
 	},
 	'session':{
 		'secret': 'AwEsOmE'
+	},
+	'cache':{
+		# 查询结果缓存，默认关闭
+		'enabled': False,
+		'maxsize': 1000,
+		'ttl': 60
+	},
+	'query_stats':{
+		# 超过slow_threshold秒的语句记入慢查询日志，explain为True时自动EXPLAIN慢的select
+		'enabled': True,
+		'slow_threshold': 0.5,
+		'explain': False
+	},
+	'query_trace':{
+		# N+1查询检测：dev为每个请求都记录并返回响应头，prod为按sample_rate抽样统计
+		'mode': 'dev',
+		'sample_rate': 0.01,
+		# 同一语句形式在一个请求中执行的次数达到threshold时报告
+		'threshold': 5
+	},
+	'json':{
+		# API响应的JSON实现：auto(安装了orjson时使用orjson)、orjson或json
+		'backend': 'auto'
+	},
+	'counters':{
+		# 行数计数器与数据库校准的间隔(秒)
+		'reconcile_interval': 300
 	}
 }
 
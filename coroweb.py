@@ -1,21 +1,33 @@
 #!/usr/bin/python
 # coding:utf-8
 
-import functools, logging, inspect, asyncio, os
+import functools, logging, inspect, asyncio, os, json, shutil, tempfile
 from aiohttp import web
+from multidict import MultiDict
 from urllib import parse
 from apis import APIError
 logging.basicConfig(level=logging.INFO)
 
 
+# 请求体默认的大小上限(字节)，上传文件的路由用max_body单独设置
+MAX_BODY_SIZE = 1024 * 1024
+# 上传的文件超过这个大小后写入临时文件，不再保存在内存中
+SPOOL_THRESHOLD = 256 * 1024
+# 读取请求体时每次读取的字节数
+BODY_CHUNK_SIZE = 64 * 1024
+
 # 建立视图函数装饰器，用来存储、附带URL信息
-def Handler_decorator(path, *, method):
+# lane为该路由使用的连接池优先级通道(如'admin')，见pool.py
+# max_body为该路由请求体的大小上限，超出时返回413
+def Handler_decorator(path, *, method, lane=None, max_body=None):
 	def decorator(func):
 		@functools.wraps(func)
 		def warpper(*args, **kw):
 			return func(*args, **kw)
 		warpper.__route__ = path
 		warpper.__method__ = method
+		warpper.__lane__ = lane
+		warpper.__max_body__ = max_body
 		return warpper
 	return decorator
 # 偏函数。GET POST 方法的路由装饰器
@@ -33,25 +45,250 @@ post = functools.partial(Handler_decorator, method = 'POST')
 # POSITIONAL_ONLY 这类型在官方说明是不会出现在普通函数的,所以我们可以不考虑
 # POSITIONAL_ONLY          位置参数
 
-# 获取命名关键词参数
-def get_named_kw_args(fn):
-	args = []
-	params = inspect.signature(fn).parameters
-	for name, param in params.items():
-		if param.kind == inspect.Parameter.KEYWORD_ONLY:
-			args.append(name)
-	return tuple(args)
-
-
-# 判断是否含有名叫'request'的参数
-def has_request_arg(fn):
-	params = inspect.signature(fn).parameters
-	found = False
-	for name, param in params.items():
-		if name == 'request':
-			found = True
-			continue
-	return found
+# 参数的类型转换：按注解(int、float、bool、str、list、List[int]等)转换，没有注解时按默认值的类型
+# 不能转换时抛出ValueError或TypeError，由RequestHandler返回400
+_TRUE_VALUES = ('1', 'true', 'yes', 'on')
+_FALSE_VALUES = ('0', 'false', 'no', 'off', '')
+
+def _to_bool(value):
+	if isinstance(value, bool):
+		return value
+	s = str(value).lower()
+	if s in _TRUE_VALUES:
+		return True
+	if s in _FALSE_VALUES:
+		return False
+	raise ValueError('Invalid bool value: %s' % value)
+
+def _to_str(value):
+	if not isinstance(value, (str, int, float)):
+		raise TypeError('Expected a string: %s' % value)
+	return value if isinstance(value, str) else str(value)
+
+# multipart/form-data中的文件
+class UploadFile(object):
+	def __init__(self, name, filename, content_type=None, threshold=SPOOL_THRESHOLD):
+		self.name = name
+		self.filename = filename
+		self.content_type = content_type
+		self.size = 0
+		self._threshold = threshold
+		self.file = tempfile.SpooledTemporaryFile(max_size=threshold)
+
+	# 超过threshold后写的是磁盘文件，放到线程池中执行
+	async def write(self, chunk):
+		self.size += len(chunk)
+		if self.size > self._threshold:
+			await asyncio.get_event_loop().run_in_executor(None, self.file.write, chunk)
+		else:
+			self.file.write(chunk)
+
+	# 逐块读取文件内容：async for chunk in upload: ...
+	async def stream(self, chunk_size=BODY_CHUNK_SIZE):
+		loop = asyncio.get_event_loop()
+		self.file.seek(0)
+		while True:
+			chunk = await loop.run_in_executor(None, self.file.read, chunk_size)
+			if not chunk:
+				break
+			yield chunk
+
+	def __aiter__(self):
+		return self.stream()
+
+	# 读取全部内容，只适合小文件
+	async def read(self):
+		self.file.seek(0)
+		return await asyncio.get_event_loop().run_in_executor(None, self.file.read)
+
+	# 保存到path
+	async def save(self, path):
+		def copy():
+			self.file.seek(0)
+			with open(path, 'wb') as f:
+				shutil.copyfileobj(self.file, f, BODY_CHUNK_SIZE)
+		await asyncio.get_event_loop().run_in_executor(None, copy)
+
+	def close(self):
+		self.file.close()
+
+	def __repr__(self):
+		return '<UploadFile %s: %s, %s bytes>' % (self.name, self.filename, self.size)
+
+def _to_upload(value):
+	if not isinstance(value, UploadFile):
+		raise TypeError('Expected a file: %s' % value)
+	return value
+
+_CONVERTERS = {int: int, float: float, bool: _to_bool, str: _to_str, UploadFile: _to_upload}
+
+# 返回(转换函数, 是否为列表)，转换函数为None时不转换
+def _converter(param):
+	tp = param.annotation
+	if tp is inspect.Parameter.empty:
+		default = param.default
+		# 没有注解时，默认值为int、float、bool的参数按该类型转换，其它原样传入
+		tp = type(default) if type(default) in (int, float, bool) else None
+	if tp is list or getattr(tp, '__origin__', None) is list:
+		item = getattr(tp, '__args__', None)
+		return (_CONVERTERS.get(item[0], None) if item else None), True
+	if tp is not None and tp not in _CONVERTERS:
+		raise ValueError('Unsupported argument type: %s %s' % (param.name, tp))
+	return _CONVERTERS.get(tp, None), False
+
+_MISSING = object()
+
+# 注册路由时根据视图函数的签名编译参数绑定，每次请求只按编译好的参数表取值、转换，不再检查签名
+# 命名关键词参数：GET时来自查询字符串，POST时来自请求体(json、表单或multipart)；其它参数来自URL路径(match_info)；
+# 名叫request的参数传入web.Request；上传的文件用UploadFile注解
+class ArgumentBinder(object):
+	def __init__(self, fn):
+		self.max_body = getattr(fn, '__max_body__', None) or MAX_BODY_SIZE
+		params = inspect.signature(fn).parameters
+		self.has_request_arg = 'request' in params
+		# (参数名, 转换函数, 是否为列表, 默认值)，必选参数的默认值为_MISSING
+		self.named_kw_args = []
+		# 路径参数名 ==> 转换函数
+		self.path_args = dict()
+		for name, param in params.items():
+			if name == 'request' or param.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD):
+				continue
+			convert, many = _converter(param)
+			if param.kind == inspect.Parameter.KEYWORD_ONLY:
+				default = _MISSING if param.default is inspect.Parameter.empty else param.default
+				self.named_kw_args.append((name, convert, many, default))
+			elif convert is not None:
+				self.path_args[name] = convert
+		self.named_kw_args = tuple(self.named_kw_args)
+
+	# 返回调用视图函数的关键词参数；参数缺失或类型不对时抛出web.HTTPBadRequest，请求体过大时抛出413
+	# 上传的文件加入uploads，由调用者在请求结束后关闭
+	async def bind(self, request, uploads):
+		kw = dict()
+		if self.named_kw_args:
+			if request.method == 'POST':
+				source = await self._body(request, uploads)
+				# 表单中同名的多个值按列表取出
+				many_source = source if isinstance(source, MultiDict) else None
+			else:
+				source = many_source = request.query
+			for name, convert, many, default in self.named_kw_args:
+				value = source.get(name, _MISSING)
+				if value is None:
+					# json中的null
+					kw[name] = None if default is _MISSING else default
+					continue
+				if value is _MISSING:
+					if default is _MISSING:
+						raise web.HTTPBadRequest(text='Missing argument: %s' % name)
+					kw[name] = default
+					continue
+				if many:
+					if many_source is not None:
+						value = many_source.getall(name)
+					elif not isinstance(value, list):
+						value = [value]
+				try:
+					if convert is not None:
+						value = [convert(v) for v in value] if many else convert(value)
+				except (ValueError, TypeError):
+					raise web.HTTPBadRequest(text='Invalid value for argument: %s' % name)
+				kw[name] = value
+		for name, value in request.match_info.items():
+			convert = self.path_args.get(name, None)
+			if convert is not None:
+				try:
+					value = convert(value)
+				except (ValueError, TypeError):
+					raise web.HTTPBadRequest(text='Invalid value for argument: %s' % name)
+			kw[name] = value
+		if self.has_request_arg:
+			kw['request'] = request
+		return kw
+
+	# 解析POST的请求体，边读边检查大小
+	async def _body(self, request, uploads):
+		# 根据request参数中的content_type使用不同解析方法：
+		if not request.content_type: # 如果content_type不存在，返回400错误
+			raise web.HTTPBadRequest(text='Missing Content_Type.')
+		if request.content_length is not None and request.content_length > self.max_body:
+			raise web.HTTPRequestEntityTooLarge(max_size=self.max_body, actual_size=request.content_length)
+		ct = request.content_type.lower() # 小写，便于检查
+		if ct.startswith('application/json'):  # json格式数据
+			body = bytearray()
+			async for chunk in self._chunks(request.content.iter_chunked(BODY_CHUNK_SIZE)):
+				body.extend(chunk)
+			try:
+				params = json.loads(body.decode(request.charset or 'utf-8'))
+			except ValueError:
+				raise web.HTTPBadRequest(text='Invalid JSON body.')
+			if not isinstance(params, dict): # json请求体必须是对象
+				raise web.HTTPBadRequest(text='JSON body must be object.')
+			return params
+		if ct.startswith('application/x-www-form-urlencoded'):
+			return await self._urlencoded(request)
+		if ct.startswith('multipart/form-data'):
+			return await self._multipart(request, uploads)
+		raise web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+
+	# 逐块返回数据，累计超过max_body时抛出413；total为多个来源共用的计数
+	async def _chunks(self, chunks, total=None):
+		total = total if total is not None else [0]
+		async for chunk in chunks:
+			total[0] += len(chunk)
+			if total[0] > self.max_body:
+				raise web.HTTPRequestEntityTooLarge(max_size=self.max_body, actual_size=total[0])
+			yield chunk
+
+	# 流式解析application/x-www-form-urlencoded：按&切分已读到的数据，只保留最后一段不完整的键值对
+	async def _urlencoded(self, request):
+		charset = request.charset or 'utf-8'
+		form = MultiDict()
+		rest = b''
+		async for chunk in self._chunks(request.content.iter_chunked(BODY_CHUNK_SIZE)):
+			pairs = (rest + chunk).split(b'&')
+			rest = pairs.pop()
+			for pair in pairs:
+				_add_pair(form, pair, charset)
+		_add_pair(form, rest, charset)
+		return form
+
+	# 流式解析multipart/form-data：普通字段读入内存，文件逐块写入UploadFile
+	async def _multipart(self, request, uploads):
+		form = MultiDict()
+		total = [0]
+		reader = await request.multipart()
+		while True:
+			part = await reader.next()
+			if part is None:
+				break
+			if not hasattr(part, 'read_chunk'):
+				raise web.HTTPBadRequest(text='Nested multipart is not supported.')
+			if part.filename is None:
+				value = bytearray()
+				async for chunk in self._chunks(_part_chunks(part), total):
+					value.extend(chunk)
+				form.add(part.name, value.decode(part.get_charset('utf-8')))
+			else:
+				upload = UploadFile(part.name, part.filename, part.headers.get('Content-Type', None))
+				uploads.append(upload)
+				async for chunk in self._chunks(_part_chunks(part), total):
+					await upload.write(chunk)
+				form.add(part.name, upload)
+		return form
+
+def _add_pair(form, pair, charset):
+	if not pair:
+		return
+	name, _, value = pair.decode('latin-1').partition('=')
+	form.add(parse.unquote_plus(name, encoding=charset), parse.unquote_plus(value, encoding=charset))
+
+async def _part_chunks(part):
+	while True:
+		chunk = await part.read_chunk(BODY_CHUNK_SIZE)
+		if not chunk:
+			break
+		yield chunk
 
 # 定义RequestHandler从视图函数中分析其需要接受的参数，从web.Request中获取必要的参数
 # 调用视图函数，然后把结果转换为web.Response对象，符合aiohttp框架要求
@@ -59,51 +296,25 @@ class RequestHandler(object):
 	def __init__(self, app, fn):
 		self._app = app
 		self._func = fn
-		self._named_kw_args = get_named_kw_args(fn)
-		self._has_request_arg = has_request_arg(fn)
+		self._binder = ArgumentBinder(fn)
 
 	async def __call__(self, request):
-		logging.info('!fn:%s'%inspect.signature(self._func))
-
-		kw = None # 定义kw，用于保存request中参数
-		if request.method == 'POST':
-			# 根据request参数中的content_type使用不同解析方法：
-			if request.content_type == None: # 如果content_type不存在，返回400错误
-				return web.HTTPBadRequest(text='Missing Content_Type.')
-			ct = request.content_type.lower() # 小写，便于检查
-			# ct = 'application/x-www-form-urlencoded'
-			if ct.startswith('application/json'):  # json格式数据
-				params = await request.json() # 仅解析body字段的json数据
-				if not isinstance(params, dict): # request.json()返回dict对象
-					return web.HTTPBadRequest(text='JSON body must be object.')
-				kw = params
-			else:
-				return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-		if request.method == 'GET':
-			kw = dict()
-			qs = request.query_string # 返回URL查询语句，?后的键值。string形式。
-			logging.info('!GET, fn:%s, query_string:%s'%(self._func, qs))
-			if qs:
-				for k, v in parse.parse_qs(qs, True).items(): # 返回查询变量和值的映射，dict对象。True表示不忽略空格。
-					kw[k] = v[0]
-		copy = dict()
-		for name in self._named_kw_args:
-			if name in kw:
-				copy[name] = kw[name]
-		kw = copy
-
-		for k, v in request.match_info.items():
-			kw[k] = v
-
-		if self._has_request_arg:
-			kw['request'] = request
-
-		logging.info('call with args: %s' % str(kw))
+		uploads = []
 		try:
-			r = await self._func(**kw)
-			return r
-		except APIError as e:
-			return dict(error=e.error, data=e.data, message=e.message)
+			try:
+				kw = await self._binder.bind(request, uploads)
+			except web.HTTPClientError as e:
+				return e
+			logging.info('call with args: %s' % str(kw))
+			try:
+				r = await self._func(**kw)
+				return r
+			except APIError as e:
+				return dict(error=e.error, data=e.data, message=e.message)
+		finally:
+			# 删除上传文件的临时文件
+			for upload in uploads:
+				upload.close()
 
 
 
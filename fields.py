@@ -4,26 +4,31 @@
 # 定义Field基类，负责保存db表的字段名和字段类型
 
 class Field(object):
-    def __init__(self, ddl, primary_key, default):
+    def __init__(self, ddl, primary_key, default, deferred=False, index=False, unique=False):
         self.ddl = ddl
         self.primary_key = primary_key
         self.default = default
+        # 延迟加载：findAll默认不查询该字段，需要时通过Model.load()再取
+        self.deferred = deferred
+        # 为该字段建立(唯一)索引，由schema.py生成DDL
+        self.index = index or unique
+        self.unique = unique
         L=[]
 
     def __str__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.ddl)
 class StringField(Field):
-    def __init__(self, ddl='varchar(255)', primary_key=False, default=None):
-        super(StringField, self).__init__(ddl, primary_key, default)
+    def __init__(self, ddl='varchar(255)', primary_key=False, default=None, **kw):
+        super(StringField, self).__init__(ddl, primary_key, default, **kw)
 class IntegerField(Field):
-    def __init__(self, ddl='bigint', primary_key=False, default=0):
-        super(IntegerField, self).__init__(ddl, primary_key, default)
+    def __init__(self, ddl='bigint', primary_key=False, default=0, **kw):
+        super(IntegerField, self).__init__(ddl, primary_key, default, **kw)
 class BooleanField(Field):
-    def __init__(self, ddl='Boolean', primary_key=False, default=False):
-        super(BooleanField, self).__init__(ddl, primary_key, default)
+    def __init__(self, ddl='Boolean', primary_key=False, default=False, **kw):
+        super(BooleanField, self).__init__(ddl, primary_key, default, **kw)
 class TextField(Field):
-    def __init__(self, ddl='Text', primary_key=False, default=None):
-        super(TextField, self).__init__(ddl, primary_key, default)
+    def __init__(self, ddl='Text', primary_key=False, default=None, **kw):
+        super(TextField, self).__init__(ddl, primary_key, default, **kw)
 class FloatField(Field):
-    def __init__(self, ddl='real', primary_key=False, default=None):
-        super(FloatField, self).__init__(ddl, primary_key, default)	
\ No newline at end of file
+    def __init__(self, ddl='real', primary_key=False, default=None, **kw):
+        super(FloatField, self).__init__(ddl, primary_key, default, **kw)	
\ No newline at end of file
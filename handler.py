@@ -2,11 +2,11 @@
 # coding:utf-8
 
 from models import User, Blog, Comment, next_id
-from coroweb import get, post
+from coroweb import get, post, UploadFile
 from aiohttp import web
 from config import configs
 from apis import APIError, APIValueError, APIPermissionError, APIResourceNotfoundError, Page
-import asyncio, time, re, hashlib, json, logging, markdown2
+import asyncio, time, re, hashlib, json, logging, markdown2, sys, orm, images, serializers
 logging.basicConfig(level=logging.INFO)
 
 
@@ -47,8 +47,8 @@ async def cookie2user(cookie_str):
 		if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
 			logging.info('Invalid sha1')
 			return None
-		# 覆盖user的password字段
-		user.password = '******'
+		# 覆盖user的password字段：在副本上覆盖，find返回的实例由请求的identity map共用，修改它会被之后的update()写入数据库
+		user = User(**dict(user, password='******'))
 		#返回的是User类
 		return user
 	except Exception as e:
@@ -65,6 +65,24 @@ def get_page_index(page_str):
 		p = 1
 	return p
 
+# 取一页数据，返回(Page, 本页数据)：带游标时走键集分页(findSeek)，否则走offset分页
+# 本页的查询条件只取决于页码和游标，与总行数互不依赖，两者并发查询
+async def find_page(model, page_index, cursor=None, **kw):
+	# 总数不限时的Page，只用来确定本页的offset和游标
+	probe = Page(sys.maxsize, page_index, cursor=cursor)
+	num, items = await orm.gather(model.findCount(), _find_items(model, probe, **kw))
+	page = Page(num, page_index, cursor=cursor)
+	if page.limit == 0:
+		# 页码超出了总页数
+		items = []
+	page.set_cursors(items)
+	return page, items
+
+async def _find_items(model, page, **kw):
+	if page.seek:
+		return await model.findSeek(seek=page.seek, limit=page.limit, **kw)
+	return await model.findAll(orderBy='created_at desc, id desc', limit=(page.offset, page.limit), **kw)
+
 def text2html(text):
 	# HTML转义字符
 	# "				&quot;
@@ -79,14 +97,9 @@ def text2html(text):
 # -------------------------------------------------------用户浏览页面----------------------------------------------------------------
 # 主页
 @get('/')
-async def index(request, *, page='1'):
-	page_index = get_page_index(page)
-	num = await Blog.findNumber('count(id)')
-	page = Page(num, page_index)
-	if num == 0:
-		blogs = []
-	else:
-		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+async def index(request, *, page: int = 1, cursor=None):
+	# 主页只显示标题、摘要和发表时间
+	page, blogs = await find_page(Blog, get_page_index(page), cursor, fields=('name', 'summary', 'created_at'), compact=True)
 	return {
 		'__template__': 'blogs.html',
 		'page': page,
@@ -119,8 +132,10 @@ def signout(request):
 #获取日志
 @get('/blog/{id}')
 async def get_blog(id, request):
-	blog = await Blog.find(id)
-	comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+	# 日志(含延迟加载的正文)和评论一次往返查询
+	blog, comments = await orm.batch(
+		Blog.query(*Blog.__fields__).where(id=id).statement('first'),
+		Comment.query().where(blog_id=id).orderBy('-created_at'))
 	for c in comments:
 		c.html_content = text2html(c.content)
 	blog.html_content = markdown2.markdown(blog.content)
@@ -144,10 +159,11 @@ async def response_404(request):
 
 # 日志列表
 @get('/manage/blogs')
-def manage_blogs(request, *, page='1'):
+def manage_blogs(request, *, page: int = 1, cursor=''):
 	return {
 		'__template__': 'manage_blogs.html',
 		'page_index': get_page_index(page),
+		'cursor': cursor,
 		'__user__': request.__user__
 	}
 
@@ -172,22 +188,32 @@ async def manage_edit_blog(request, *, id):
 	}
 
 
+# 上传图片
+@get('/manage/images')
+def manage_images(request):
+	return {
+		'__template__': 'image_edit.html',
+		'__user__': request.__user__
+	}
+
 # 用户列表
 @get('/manage/users')
-def manage_users(request, *, page='1'):
+def manage_users(request, *, page: int = 1, cursor=''):
 	return {
 		'__template__': 'manage_users.html',
 		'page_index': get_page_index(page),
+		'cursor': cursor,
 		'__user__': request.__user__
 	}
 
 
 #评论列表
 @get('/manage/comments')
-def manage_comments(request, *, page='1'):
+def manage_comments(request, *, page: int = 1, cursor=''):
 	return {
 		'__template__': 'manage_comments.html',
 		'page_index': get_page_index(page),
+		'cursor': cursor,
 		'__user__': request.__user__
 	}
 
@@ -198,20 +224,35 @@ def check_damin(request):
 	if request.__user__ is None or not request.__user__.admin:
 		raise APIPermissionError()
 
+# 数据库运行状况：各语句形式的耗时汇总、各路由的查询次数、连接池各通道的等待、查询缓存命中率
+@get('/api/stats/queries', lane='admin')
+def api_query_stats(request, *, top: int = 20, order='total'):
+	check_damin(request)
+	try:
+		queries = orm.query_stats.stats(top, order)
+	except KeyError:
+		raise APIValueError('order', 'Invalid order.')
+	return dict(queries=queries, requests=orm.query_stats.requests(), pools=orm.pool_stats(), cache=orm.query_cache.stats())
+
+# 上传图片：返回原图和头像、缩略图的URL，相同的图片只保存一份
+@post('/api/images', max_body=images.MAX_UPLOAD_SIZE)
+async def api_upload_image(request, *, image: UploadFile):
+	if request.__user__ is None:
+		raise APIPermissionError('Please signin first.')
+	try:
+		return await images.store(image)
+	except ValueError as e:
+		raise APIValueError('image', str(e))
+
 # 获取日志：用于管理日志页面
-@get('/api/blogs')
-async def api_blogs(*, page=1):
-	page_index = get_page_index(page)
-	num = await Blog.findNumber('count(id)')
-	# 建立Page类分页
-	p = Page(item_count=num, page_index=page_index)
-	if num == 0:
-		return dict(page = p, blogs=())
-	blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/blogs', lane='admin')
+async def api_blogs(*, page: int = 1, cursor=None):
+	# 只读列表，使用紧凑的Row
+	p, blogs = await find_page(Blog, get_page_index(page), cursor, compact=True)
 	return dict(page = p, blogs=blogs)
 
 # 创建日志：用于创建日志页面
-@post('/api/blogs/create')
+@post('/api/blogs/create', lane='admin')
 async def api_create_blog(request, *, name, summary, content):
 	check_damin(request)
 	if not name or not name.strip():
@@ -239,7 +280,7 @@ async def api_get_blog(id):
 	return blog
 
 # 修改日志：用于修改日志页面
-@post('/api/blogs/{id}')
+@post('/api/blogs/{id}', lane='admin')
 async def api_update_blog(id, request, *, name, summary, content):
 	check_damin(request)
 	blog = await Blog.find(id)
@@ -256,7 +297,7 @@ async def api_update_blog(id, request, *, name, summary, content):
 	return blog
 
 # 删除日志
-@post('/api/blogs/{id}/delete')
+@post('/api/blogs/{id}/delete', lane='admin')
 async def api_delete_blog(id, request):
 	check_damin(request)
 	blog = await Blog.find(id)
@@ -264,15 +305,10 @@ async def api_delete_blog(id, request):
 	return dict(id=id)
 
 #获取用户列表：用于管理用户
-@get('/api/users')
-async def api_users(*, page=1):
-	page_index = get_page_index(page)
-	num = await User.findNumber('count(id)')
-	# 建立Page类分页
-	p = Page(item_count=num, page_index=page_index)
-	if num == 0:
-		return dict(page = p, users=())
-	users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/users', lane='admin')
+async def api_users(*, page: int = 1, cursor=None):
+	# 只读列表，使用紧凑的Row
+	p, users = await find_page(User, get_page_index(page), cursor, compact=True)
 	return dict(page = p, users=users)
 
 
@@ -285,7 +321,7 @@ async def api_register_user(*, name, email, password, image):
 		raise APIValueError('email')
 	if not password or not _RE_SHA1.match(password):
 		raise APIValueError('password')
-	users = await User.findAll('email=?', [email])
+	users = await User.query().where(email=email).all()
 	# 判断邮箱是否已被注册
 	if len(users)>0:
 		raise APIError('register: failed', 'email', 'Email is already in use.')
@@ -306,7 +342,7 @@ async def api_register_user(*, name, email, password, image):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.password = '******' # 在上下文环境中掩盖user对象的password字段，并不影响数据库中password字段
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = serializers.dumps(user)
 	return r
 
 # 用户登陆
@@ -317,7 +353,7 @@ async def authenticate(*, email, password):
 		raise APIValueError('email', 'Invalid email.')
 	if not password:
 		raise APIValueError('password', 'Invalid password.')
-	users = await User.findAll('email=?', [email])
+	users = await User.query().where(email=email).all()
 	if len(users) == 0:
 		raise APIValueError('email', 'Emial not exist.')
 	user = users[0] # findAll返回的是仅含一个user对象的list
@@ -329,23 +365,24 @@ async def authenticate(*, email, password):
 	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
 	user.password = '******' 
 	r.content_type = 'application/json'
-	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+	r.body = serializers.dumps(user)
 	return r	
 
 
 
 # 获取评论：用于评论管理页面
-@get('/api/comments')
-async def api_comments(*, page=1):
-	page_index = get_page_index(page)
-	num = await Comment.findNumber('count(id)')
-	# 建立Page类分页
-	p = Page(item_count=num, page_index=page_index)
-	if num == 0:
-		return dict(page = p, comments=())
-	comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@get('/api/comments', lane='admin')
+async def api_comments(*, page: int = 1, cursor=None):
+	# 只读列表，使用紧凑的Row
+	p, comments = await find_page(Comment, get_page_index(page), cursor, compact=True)
 	return dict(page = p, comments=comments)
 
+# 导出全部评论：返回异步迭代器，由response_factory流式输出为JSON数组，?format=ndjson时输出NDJSON
+@get('/api/comments/export', lane='batch')
+def api_export_comments(request):
+	check_damin(request)
+	return Comment.stream(orderBy='created_at desc')
+
 #创建评论
 @post('/api/blogs/{id}/comments')
 async def api_create_comment(id, request, *, content):
@@ -368,7 +405,7 @@ async def api_create_comment(id, request, *, content):
 	return comment
 
 # 删除评论
-@post('/api/comments/{id}/delete')
+@post('/api/comments/{id}/delete', lane='admin')
 async def api_delete_comment(id, request):
 	check_damin(request)
 	comment = await Comment.find(id)
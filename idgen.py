@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# Snowflake式的id生成器：毫秒时间戳(15位) + 进程号(4位) + 毫秒内序号(4位)，共23位十进制字符串
+# 与原来next_id生成的15位毫秒时间戳id前缀相同、定长，按字符串排序仍是按生成时间排序，旧id都排在新id前面
+# 多机或多进程部署时必须用环境变量BLOG_WORKER_ID为每个进程指定不同的值(0~9999)
+# 未指定时由主机名和pid计算，不同主机、不同进程的计算结果可能相同，生成重复的id，所以会输出警告
+
+import logging, os, socket, threading, time, zlib
+
+MAX_WORKER_ID = 9999
+MAX_SEQUENCE = 9999
+
+def _default_worker_id():
+	worker_id = os.environ.get('BLOG_WORKER_ID', None)
+	if worker_id is not None:
+		return int(worker_id)
+	worker_id = (zlib.crc32(socket.gethostname().encode('utf-8')) + os.getpid()) % (MAX_WORKER_ID + 1)
+	logging.warning('BLOG_WORKER_ID is not set, using worker id %s derived from hostname and pid; '
+		'ids may collide when several processes or hosts share a database, set a unique BLOG_WORKER_ID for each process' % worker_id)
+	return worker_id
+
+class IdGenerator(object):
+	def __init__(self, worker_id=None):
+		self._lock = threading.Lock()
+		self._fixed = worker_id is not None
+		self.reset(worker_id)
+
+	def reset(self, worker_id=None):
+		if worker_id is None:
+			worker_id = _default_worker_id()
+		if not 0 <= worker_id <= MAX_WORKER_ID:
+			raise ValueError('Invalid worker id: %s' % worker_id)
+		self.worker_id = worker_id
+		self._last = 0
+		self._sequence = 0
+
+	def next_id(self):
+		with self._lock:
+			now = int(time.time() * 1000)
+			# 时钟回拨时沿用上次的时间戳，保证单调递增
+			if now <= self._last:
+				if self._sequence >= MAX_SEQUENCE:
+					# 时钟回拨后序号用完：报错，不在持有锁时一直等到时钟追上
+					if now < self._last:
+						raise RuntimeError('Clock moved backwards by %sms and the id sequence is exhausted' % (self._last - now))
+					# 本毫秒的序号用完，等到下一毫秒
+					while now <= self._last:
+						now = int(time.time() * 1000)
+					self._sequence = 0
+				else:
+					now = self._last
+					self._sequence += 1
+			else:
+				self._sequence = 0
+			self._last = now
+			return '%015d%04d%04d' % (now, self.worker_id, self._sequence)
+
+	# fork出的子进程重新计算进程号并清空状态，避免与父进程生成相同的id
+	def _after_fork(self):
+		self._lock = threading.Lock()
+		self.reset(self.worker_id if self._fixed else None)
+
+generator = IdGenerator()
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=generator._after_fork)
+
+def next_id():
+	return generator.next_id()
+
+
+# 性能测试：python idgen.py [数量]
+if __name__ == '__main__':
+	import sys
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	start = time.time()
+	ids = [next_id() for i in range(n)]
+	elapsed = time.time() - start
+	assert len(set(ids)) == n and ids == sorted(ids)
+	print('%s ids in %.3fs: %.0f ids/sec, worker id %s, e.g. %s' % (n, elapsed, n / elapsed, generator.worker_id, ids[-1]))
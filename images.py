@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# 上传图片的存储：按内容的sha256保存在static/uploads下，同一图片只保存一份
+# 解码和生成缩略图(头像、列表缩略图)在进程池中执行，不阻塞事件循环
+# 文件名包含内容哈希，内容不会变化，app.py对这些文件返回永久缓存的响应头
+# 生成缩略图需要安装Pillow
+
+import asyncio, hashlib, logging, multiprocessing, os, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+UPLOAD_URL = '/static/uploads/'
+# 上传图片的大小上限(字节)
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# 解码时允许的最大像素数，防止解压炸弹
+MAX_PIXELS = 40000000
+# 缩略图：名称 ==> (宽, 高, 是否裁剪为该比例)；不裁剪时按比例缩小到该范围内
+VARIANTS = {
+	'avatar': (120, 120, True),
+	'thumb': (400, 300, False)
+}
+# 支持的格式 ==> 扩展名
+FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+IMAGE_WORKERS = 2
+
+_executor = None
+# 正在处理的图片：哈希 ==> future，同时上传同一图片时只处理一次
+_pending = dict()
+
+def _get_executor():
+	global _executor
+	if _executor is None:
+		# 主进程中有数据库、线程池等线程，fork出的子进程可能继承被其它线程持有的锁而死锁，改用forkserver(不支持时用spawn)
+		method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+		_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context(method))
+	return _executor
+
+# 按哈希的前两位分目录
+def _directory(digest):
+	return os.path.join(UPLOAD_DIR, digest[:2])
+
+def _urls(digest, ext):
+	prefix = '%s%s/%s' % (UPLOAD_URL, digest[:2], digest)
+	urls = dict((name, '%s_%s.%s' % (prefix, name, ext)) for name in VARIANTS)
+	urls['original'] = '%s.%s' % (prefix, ext)
+	urls['hash'] = digest
+	return urls
+
+# 已保存过的图片返回扩展名，否则返回None
+def _existing(digest):
+	directory = _directory(digest)
+	for ext in FORMATS.values():
+		if os.path.exists(os.path.join(directory, '%s.%s' % (digest, ext))):
+			return ext
+	return None
+
+# 在子进程中执行：校验并解码图片，生成各尺寸的缩略图，最后把原图移到按哈希命名的位置
+# 先写临时文件再改名，其它请求看到的文件总是完整的
+def _process(path, directory, digest):
+	from PIL import Image
+	Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+	try:
+		return _resize(path, directory, digest)
+	except (OSError, Image.DecompressionBombError) as e:
+		# Pillow无法识别、解码或图片过大
+		raise ValueError('Invalid image: %s' % type(e).__name__)
+
+def _resize(path, directory, digest):
+	from PIL import Image, ImageOps
+	with Image.open(path) as im:
+		ext = FORMATS.get(im.format, None)
+		if ext is None:
+			raise ValueError('Unsupported image format: %s' % im.format)
+		fmt = im.format
+		im.load()
+		# 校验通过后才创建目录，被拒绝的上传不留下空目录
+		os.makedirs(directory, exist_ok=True)
+		for name, (width, height, crop) in VARIANTS.items():
+			if crop:
+				variant = ImageOps.fit(im, (width, height))
+			else:
+				variant = im.copy()
+				variant.thumbnail((width, height))
+			target = os.path.join(directory, '%s_%s.%s' % (digest, name, ext))
+			variant.save(target + '.tmp', format=fmt)
+			os.replace(target + '.tmp', target)
+	os.replace(path, os.path.join(directory, '%s.%s' % (digest, ext)))
+	return ext
+
+# 保存上传的图片(coroweb.UploadFile)，返回原图和各缩略图的URL；不是支持的图片时抛出ValueError
+async def store(upload):
+	loop = asyncio.get_event_loop()
+	os.makedirs(UPLOAD_DIR, exist_ok=True)
+	# 边计算哈希边写入上传目录下的临时文件，与最终位置在同一文件系统，可以直接改名
+	fd, path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.upload')
+	owner = False
+	try:
+		h = hashlib.sha256()
+		with os.fdopen(fd, 'wb') as f:
+			async for chunk in upload:
+				h.update(chunk)
+				await loop.run_in_executor(None, f.write, chunk)
+		digest = h.hexdigest()
+		ext = _existing(digest)
+		if ext is not None:
+			logging.info('image exists: %s' % digest)
+			return _urls(digest, ext)
+		fut = _pending.get(digest, None)
+		owner = fut is None
+		if owner:
+			fut = _pending[digest] = loop.run_in_executor(_get_executor(), _process, path, _directory(digest), digest)
+			# 临时文件在处理结束后删除(成功时已被改名)，即使请求已被取消
+			fut.add_done_callback(lambda f: _remove(path))
+		try:
+			# 请求被取消时子进程中的处理照常完成
+			ext = await asyncio.shield(fut)
+		finally:
+			if owner:
+				_pending.pop(digest, None)
+		if owner:
+			logging.info('image stored: %s.%s (%s bytes)' % (digest, ext, upload.size))
+		return _urls(digest, ext)
+	finally:
+		if not owner:
+			_remove(path)
+
+def _remove(path):
+	if os.path.exists(path):
+		os.remove(path)
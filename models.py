@@ -2,22 +2,25 @@
 # coding:utf-8
 
 import time, uuid
+import idgen
 from orm import Model
 from fields import StringField, BooleanField, FloatField, TextField
 
+# 毫秒时间戳+进程号+序号，同一毫秒内多次插入、多进程部署时都不会重复，见idgen.py
 def next_id():
-	return '%015d' % (int(time.time()*1000))
+	return idgen.next_id()
 
 class User(Model):
 	__table__ = 'users'
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	email = StringField(ddl='varchar(50)')
+	# 登录、注册时按email查询
+	email = StringField(ddl='varchar(50)', unique=True)
 	password = StringField(ddl='varchar(50)')
 	admin = BooleanField()
 	name = StringField(ddl='varchar(50)')
 	image = StringField(ddl='varchar(500)')
-	created_at = FloatField(default=time.time)
+	created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
 	__table__ = 'blogs'
@@ -28,11 +31,14 @@ class Blog(Model):
 	user_image = StringField(ddl='varchar(500)')
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
-	created_at = FloatField(default=time.time)
+	# 正文较大，列表页不需要，延迟加载
+	content = TextField(deferred=True)
+	created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
 	__table__ = 'comments'
+	# 日志页按blog_id查询评论并按created_at排序
+	__indexes__ = [('blog_id', 'created_at')]
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
 	blog_id = StringField(ddl = 'varchar(50)')
@@ -40,4 +46,4 @@ class Comment(Model):
 	user_name = StringField(ddl='varchar(50)')
 	user_image = StringField(ddl='varchar(500)')
 	content = TextField()
-	created_at = FloatField(default=time.time)
\ No newline at end of file
+	created_at = FloatField(default=time.time, index=True)
\ No newline at end of file
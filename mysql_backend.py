@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# MySQL后端(默认)：基于aiomysql的连接池，支持只读副本和一次发送多条语句
+# 后端模块由orm.create_pool按配置中的backend加载，需要提供下面的属性和函数，见sqlite_backend.py
+
+import aiomysql, logging
+from pymysql.constants import CLIENT
+import orm
+
+name = 'mysql'
+# 驱动使用的占位符，orm把sql中的?替换为它
+placeholder = '%s'
+# 是否支持一次发送多条语句(orm.batch)
+multi_statements = True
+# 只读副本是否有复制延迟，有延迟时写入后的一段时间内读主库(read_your_writes)
+replica_lag = True
+# 查看执行计划的语句前缀
+explain = 'explain '
+# 建表语句末尾的表选项
+table_options = ' engine=innodb default charset=utf8'
+
+DictCursor = aiomysql.DictCursor
+Cursor = aiomysql.Cursor
+SSDictCursor = aiomysql.SSDictCursor
+
+# 创建主库和只读副本的连接池，返回(主库连接池, [副本连接池])
+# kw['replicas']为只读副本的配置列表，每项只需写出与主库不同的配置(如host、port、db)
+async def create_pools(loop, **kw):
+	primary = await _create_pool(loop, **kw)
+	replicas = []
+	for replica in kw.get('replicas', None) or []:
+		conf = dict(kw)
+		conf.update(replica)
+		logging.info('create replica connection pool: %s:%s/%s' % (conf.get('host', 'localhost'), conf.get('port', 3306), conf['db']))
+		replicas.append(await _create_pool(loop, **conf))
+	return primary, replicas
+
+async def _create_pool(loop, **kw):
+	return await aiomysql.create_pool(
+		host = kw.get('host', 'localhost'),
+		port = kw.get('port', 3306),
+		user = kw['user'],
+		password = kw['password'],
+		db = kw['db'],
+		charset = kw.get('charset', 'utf8'),
+		# 是否自动提交事务，在增删改数据库文件时，如果为True,不需要再commit来提交事务
+		autocommit = kw.get('autocommit', True),
+		maxsize = kw.get('maxsize', 10),
+		minsize = kw.get('minsize', 1),
+		client_flag = CLIENT.MULTI_STATEMENTS if kw.get('multi_statements', False) else 0,
+		loop = loop)
+
+# 读取数据库中表的列，表不存在时返回None
+async def live_columns(table):
+	rs = await orm.select('select column_name as name, column_type as type from information_schema.columns where table_schema=database() and table_name=?', [table])
+	if not rs:
+		return None
+	return dict((r['name'], r['type']) for r in rs)
+
+# 读取数据库中表的索引：{索引名: (列名元组, 是否唯一)}，主键索引名为PRIMARY
+async def live_indexes(table):
+	rs = await orm.select('select index_name as name, non_unique, column_name as col from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [table])
+	indexes = dict()
+	for r in rs:
+		columns, unique = indexes.get(r['name'], ((), not r['non_unique']))
+		indexes[r['name']] = (columns + (r['col'],), unique)
+	return indexes
+
+def add_column_sql(table, column, ddl, after):
+	return 'alter table `%s` add column `%s` %s after `%s`' % (table, column, ddl, after)
+
+def drop_index_sql(table, index):
+	return 'drop index `%s` on `%s`' % (index, table)
@@ -1,8 +1,10 @@
 #!/usr/bin/python
 # coding:utf-8
 
-import aiomysql, asyncio, logging
+import asyncio, logging, re, contextvars, contextlib, time, sys, importlib
+from collections import OrderedDict
 from fields import Field
+from pool import PriorityPool, lane, current_lane
 logging.basicConfig(level=logging.INFO)
 
 
@@ -11,55 +13,637 @@ logging.basicConfig(level=logging.INFO)
 def log(sql, args=()):
 	logging.info('SQL: %s, %s' % (sql, args))
 
+# 数据库后端模块(mysql_backend、sqlite_backend)，由create_pool按kw['backend']加载
+_backend = None
+
+# 只读副本的连接池，为空时读写都使用主库
+__replicas = []
+__replica_next = 0
+# 读自己的写：当前请求写入后的这段时间(秒)内，读操作也走主库，避免读到复制延迟前的旧数据
+__read_your_writes = 1
+# 是否允许一次发送多条语句，batch()使用
+__multi_statements = False
+_last_write = contextvars.ContextVar('last_write', default=0)
+
 # 创建一个全局连接池
+# kw['backend']为数据库后端，默认为mysql，单机部署可以用sqlite，见sqlite_backend.py
+# kw['replicas']为只读副本的配置列表，每项只需写出与主库不同的配置(如host、port、db)
+# kw['lanes']为各优先级通道的预留连接数和权重，配置后每个连接池都按通道分配连接，见pool.py
+# kw['find_batch']、kw['find_batch_window']、kw['find_batch_size']为合并find调用的设置，见FindBatcher
 async def create_pool(loop, **kw):
 	logging.info('create database connection pool...')
-	global __pool
-	__pool = await aiomysql.create_pool(
-		host = kw.get('host', 'localhost'),
-		port = kw.get('port', 3306),
-		user = kw['user'],
-		password = kw['password'],
-		db = kw['db'],
-		charset = kw.get('charset', 'utf8'),
-		# 是否自动提交事务，在增删改数据库文件时，如果为True,不需要再commit来提交事务
-		autocommit = kw.get('autocommit', True),
-		maxsize = kw.get('maxsize', 10),
-		minsize = kw.get('minsize', 1),
-		loop = loop)
-	pass
+	global __pool, __replicas, __read_your_writes, __multi_statements, FIND_BATCH, FIND_BATCH_WINDOW, FIND_BATCH_SIZE
+	backend = use_backend(kw.get('backend', 'mysql'))
+	primary, replicas = await backend.create_pools(loop, **kw)
+	__pool = _with_lanes(primary, kw.get('lanes', None))
+	__replicas = [_with_lanes(p, kw.get('lanes', None)) for p in replicas]
+	# 没有复制延迟的后端不需要读自己的写
+	__read_your_writes = kw.get('read_your_writes', 1) if backend.replica_lag else 0
+	__multi_statements = backend.multi_statements and bool(kw.get('multi_statements', False))
+	FIND_BATCH = kw.get('find_batch', FIND_BATCH)
+	FIND_BATCH_WINDOW = kw.get('find_batch_window', FIND_BATCH_WINDOW)
+	FIND_BATCH_SIZE = kw.get('find_batch_size', FIND_BATCH_SIZE)
+
+# 选择数据库后端，返回后端模块；不需要连接池时(如schema.py生成DDL)也可以单独调用
+def use_backend(name):
+	global _backend, _placeholder
+	_backend = importlib.import_module('%s_backend' % name)
+	if _placeholder != _backend.placeholder:
+		_placeholder = _backend.placeholder
+		_prepared.clear()
+	return _backend
+
+# 当前的数据库后端，未选择时为mysql
+def backend():
+	return _backend or use_backend('mysql')
+
+# 连接数不够分配各通道的预留连接时(如SQLite唯一的写连接)不分通道
+def _with_lanes(pool, lanes):
+	if not lanes:
+		return pool
+	if sum(conf.get('reserved', 0) for conf in lanes.values()) > pool.maxsize:
+		logging.info('pool too small for lanes (maxsize %s), lanes disabled' % pool.maxsize)
+		return pool
+	return PriorityPool(pool, lanes)
+
+# 各连接池按通道的使用情况和排队等待时间
+def pool_stats():
+	stats = dict()
+	for name, pool in [('primary', __pool)] + [('replica%s' % i, p) for i, p in enumerate(__replicas)]:
+		if isinstance(pool, PriorityPool):
+			stats[name] = pool.stats()
+	return stats
+
+# 写操作使用主库
+def _write_pool():
+	return __pool
+
+# 读操作轮询只读副本，当前请求刚写入过或没有副本时使用主库
+def _read_pool():
+	global __replica_next
+	if not __replicas or _recently_wrote():
+		return __pool
+	__replica_next = (__replica_next + 1) % len(__replicas)
+	return __replicas[__replica_next]
+
+def _recently_wrote():
+	return time.time() - _last_write.get() < __read_your_writes
+
+# 记录当前请求的写入时间
+def _mark_write():
+	if __replicas:
+		_last_write.set(time.time())
+
+# 跨请求的读自己的写：每个请求的上下文是新的，app.py的中间件把写入时间记在cookie中，
+# 后续请求(如发表评论后刷新列表)用restore_last_write()恢复，窗口内仍读主库
+def last_write():
+	return _last_write.get()
+
+def restore_last_write(t):
+	# 时间来自客户端，不能晚于当前时间；不覆盖更近的写入时间
+	t = min(t, time.time())
+	if __replicas and t > _last_write.get():
+		_last_write.set(t)
+
+# 写入后读主库的时长(秒)，为0时不需要记录写入时间
+def read_your_writes_window():
+	return __read_your_writes if __replicas else 0
+
+# 固定的连接：connection()/transaction()作用域内所有select、execute和Model操作都使用同一个连接
+class _Pinned(object):
+	def __init__(self, conn):
+		self.conn = conn
+		# 是否已开启事务
+		self.in_transaction = False
+		# 嵌套事务(保存点)的层数
+		self.depth = 0
+		# 事务中写过的表，提交后淘汰对应的查询缓存
+		self.tables = set()
+		# 事务中对行数计数器的调整(实例, 增减)，提交后才生效，回滚时丢弃
+		self.adjustments = []
+
+_pinned = contextvars.ContextVar('pinned_connection', default=None)
+
+# 获取连接：在作用域内时返回固定的连接，否则从get_pool()返回的连接池中获取
+@contextlib.asynccontextmanager
+async def _connection(get_pool):
+	pinned = _pinned.get()
+	if pinned is not None:
+		yield pinned.conn
+	else:
+		async with get_pool().get() as conn:
+			yield conn
+
+def _in_transaction():
+	pinned = _pinned.get()
+	return pinned is not None and pinned.in_transaction
+
+# 在作用域内固定使用一个主库连接，减少连接池的获取和释放
+# 注意：作用域内不要并发执行查询(如asyncio.gather)，它们会共用同一个连接
+@contextlib.asynccontextmanager
+async def connection():
+	pinned = _pinned.get()
+	if pinned is not None:
+		yield pinned.conn
+		return
+	async with _write_pool().get() as conn:
+		token = _pinned.set(_Pinned(conn))
+		try:
+			yield conn
+		finally:
+			_pinned.reset(token)
+
+# 事务作用域：正常结束时提交，出现异常时回滚；嵌套使用时通过保存点实现部分回滚
+@contextlib.asynccontextmanager
+async def transaction():
+	pinned = _pinned.get()
+	if pinned is None:
+		async with connection():
+			async with transaction() as conn:
+				yield conn
+		return
+	conn = pinned.conn
+	if not pinned.in_transaction:
+		await conn.begin()
+		pinned.in_transaction = True
+		try:
+			yield conn
+		except BaseException:
+			await conn.rollback()
+			raise
+		else:
+			await conn.commit()
+			for table in pinned.tables:
+				query_cache.invalidate(table)
+			for instance, delta in pinned.adjustments:
+				counters.adjust(instance, delta)
+		finally:
+			pinned.in_transaction = False
+			pinned.tables.clear()
+			del pinned.adjustments[:]
+		return
+	pinned.depth += 1
+	savepoint = 'sp_%s' % pinned.depth
+	# 回滚到保存点时丢弃之后的计数调整
+	adjusted = len(pinned.adjustments)
+	async with conn.cursor() as cur:
+		await cur.execute('savepoint %s' % savepoint)
+	try:
+		yield conn
+	except BaseException:
+		async with conn.cursor() as cur:
+			await cur.execute('rollback to savepoint %s' % savepoint)
+		del pinned.adjustments[adjusted:]
+		raise
+	else:
+		async with conn.cursor() as cur:
+			await cur.execute('release savepoint %s' % savepoint)
+	finally:
+		pinned.depth -= 1
+
+# 查询结果缓存：key为规范化的sql和参数，LRU+TTL淘汰，每项记录查询涉及的表
+# 对某个表execute(包括Model.save/update/remove)时只淘汰依赖该表的缓存项；默认关闭，由configure()开启
+# 注意：缓存的结果会被多个调用者共用，不要修改select()返回的行
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.I)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.I)
+
+class QueryCache(object):
+	def __init__(self):
+		self.enabled = False
+		self.maxsize = 1000
+		self.ttl = 60
+		# key ==> (过期时间, 涉及的表, 结果, 估算的字节数)
+		self._entries = OrderedDict()
+		# 表名 ==> 依赖该表的key集合
+		self._tags = dict()
+		# 表名 ==> 写入次数，查询期间表被写入时不缓存该查询结果
+		self._versions = dict()
+		# 表名 ==> 最近一次写入的时间，无法判断表名的写入清空缓存的时间记在_cleared
+		self._written = dict()
+		self._cleared = 0
+		self._bytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, enabled=True, maxsize=1000, ttl=60):
+		self.enabled = enabled
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.clear()
+
+	def key(self, sql, args, size, tuples):
+		return (' '.join(sql.split()), tuple(args) if args else (), size, tuples)
+
+	def versions(self, tables):
+		return tuple(self._versions.get(t, 0) for t in tables)
+
+	def get(self, key):
+		entry = self._entries.get(key, None)
+		if entry is not None:
+			if entry[0] > time.time():
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return entry[2]
+			self._discard(key)
+		self.misses += 1
+		return None
+
+	def put(self, key, tables, rs, versions):
+		if not tables or self.versions(tables) != versions:
+			return
+		self._discard(key)
+		size = _sizeof(rs)
+		self._entries[key] = (time.time() + self.ttl, tables, rs, size)
+		self._bytes += size
+		for t in tables:
+			self._tags.setdefault(t, set()).add(key)
+		while len(self._entries) > self.maxsize:
+			self._discard(next(iter(self._entries)))
+
+	# 淘汰依赖该表的所有缓存项
+	def invalidate(self, table):
+		self._versions[table] = self._versions.get(table, 0) + 1
+		self._written[table] = time.time()
+		for key in list(self._tags.pop(table, ())):
+			self._discard(key)
+
+	def _discard(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self._bytes -= entry[3]
+			for t in entry[1]:
+				keys = self._tags.get(t, None)
+				if keys is not None:
+					keys.discard(key)
+
+	# 最近window秒内是否写入过这些表
+	def written_since(self, tables, window):
+		since = time.time() - window
+		return self._cleared >= since or any(self._written.get(t, 0) >= since for t in tables)
+
+	def clear(self):
+		self._entries.clear()
+		self._tags.clear()
+		self._bytes = 0
+		self._cleared = time.time()
+
+	def stats(self):
+		total = self.hits + self.misses
+		return dict(entries=len(self._entries), bytes=self._bytes, hits=self.hits, misses=self.misses,
+			hit_ratio=(self.hits / total if total else 0.0))
+
+# 估算结果集占用的内存
+def _sizeof(rs):
+	size = sys.getsizeof(rs)
+	for r in rs:
+		size += sys.getsizeof(r)
+		for v in (r.values() if isinstance(r, dict) else r):
+			size += sys.getsizeof(v)
+	return size
+
+query_cache = QueryCache()
+
+# 查询统计：记录每条语句获取连接的等待时间、执行时间和返回/影响的行数，按语句形式汇总
+# 超过slow_threshold(秒)的语句记入慢查询日志，开启explain时对慢的select自动执行EXPLAIN并记录执行计划
+# 运行时用query_stats.stats()查看各语句形式的汇总，如 query_stats.stats(top=10, order='max')
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+class QueryStats(object):
+	def __init__(self):
+		self.enabled = True
+		self.slow_threshold = 0.5
+		self.explain = False
+		# 同一语句形式两次EXPLAIN的最小间隔(秒)
+		self.explain_interval = 60
+		# 最多汇总的语句形式数，超出后新的形式计入'(other)'
+		self.maxshapes = 1000
+		# 语句形式 ==> [次数, 总耗时, 最大耗时, 总等待时间, 总行数, 慢查询次数]
+		self._shapes = dict()
+		# 语句形式 ==> (EXPLAIN时间, 执行计划)
+		self._plans = dict()
+		# 路由 ==> [抽样的请求数, 总查询次数, 单个请求最多的查询次数, 有重复查询(N+1)的请求数]
+		self._requests = dict()
+
+	def configure(self, enabled=True, slow_threshold=0.5, explain=False, explain_interval=60, maxshapes=1000):
+		self.enabled = enabled
+		self.slow_threshold = slow_threshold
+		self.explain = explain
+		self.explain_interval = explain_interval
+		self.maxshapes = maxshapes
+		self.reset()
+
+	# 语句形式：规范化空白，in (?,?,...)不论参数个数都算同一形式
+	def shape(self, sql):
+		return _RE_IN_LIST.sub('(?...)', ' '.join(sql.split()))
+
+	# wait为获取连接的等待时间，elapsed为执行和读取结果的时间(秒)
+	def record(self, sql, args, wait, elapsed, rows, explain=True):
+		logging.info('SQL done: %.1fms (wait %.1fms), rows: %s' % (elapsed * 1000, wait * 1000, rows))
+		trace = _query_trace.get()
+		if not self.enabled and trace is None:
+			return
+		shape = self.shape(sql)
+		if trace is not None:
+			trace.add(shape, elapsed)
+		if not self.enabled:
+			return
+		agg = self._shapes.get(shape, None)
+		if agg is None:
+			if len(self._shapes) >= self.maxshapes:
+				shape = '(other)'
+			agg = self._shapes.setdefault(shape, [0, 0.0, 0.0, 0.0, 0, 0])
+		agg[0] += 1
+		agg[1] += elapsed
+		agg[2] = max(agg[2], elapsed)
+		agg[3] += wait
+		agg[4] += rows
+		if elapsed >= self.slow_threshold:
+			agg[5] += 1
+			logging.warning('SLOW SQL: %.1fms (wait %.1fms), rows: %s, sql: %s, args: %s' % (elapsed * 1000, wait * 1000, rows, sql, args))
+			if self.explain and explain and sql.lstrip()[:6].lower() == 'select':
+				plan = self._plans.get(shape, None)
+				if plan is None or time.time() - plan[0] >= self.explain_interval:
+					self._plans[shape] = (time.time(), None)
+					asyncio.ensure_future(self._explain(shape, sql, args))
+
+	# 单独从连接池获取连接执行EXPLAIN，不占用调用者固定的连接
+	async def _explain(self, shape, sql, args):
+		try:
+			async with _read_pool().get() as conn:
+				async with conn.cursor(_backend.DictCursor) as cur:
+					await cur.execute(_backend.explain + _prepare(sql), args or ())
+					plan = await cur.fetchall()
+			self._plans[shape] = (time.time(), plan)
+			logging.warning('EXPLAIN %s: %s' % (sql, plan))
+		except Exception as e:
+			logging.exception(e)
+
+	# 按order('total'、'max'、'avg'、'count'、'wait'、'slow')倒序返回各语句形式的汇总，top为返回的条数
+	def stats(self, top=None, order='total'):
+		items = []
+		for shape, (count, total, most, wait, rows, slow) in self._shapes.items():
+			plan = self._plans.get(shape, None)
+			items.append(dict(sql=shape, count=count, total_ms=total * 1000, avg_ms=total / count * 1000, max_ms=most * 1000,
+				wait_ms=wait * 1000, rows=rows, slow=slow, plan=plan[1] if plan else None))
+		key = dict(total='total_ms', max='max_ms', avg='avg_ms', count='count', wait='wait_ms', slow='slow')[order]
+		items.sort(key=lambda item: -item[key])
+		return items[:top] if top else items
+
+	# 记录抽样请求的查询次数，repeated为该请求中重复次数超过阈值的语句形式
+	def record_request(self, route, trace, repeated):
+		agg = self._requests.get(route, None)
+		if agg is None:
+			if len(self._requests) >= self.maxshapes:
+				route = '(other)'
+			agg = self._requests.setdefault(route, [0, 0, 0, 0])
+		agg[0] += 1
+		agg[1] += trace.count
+		agg[2] = max(agg[2], trace.count)
+		if repeated:
+			agg[3] += 1
+
+	# 各路由的查询次数，按有重复查询的请求数倒序
+	def requests(self):
+		items = [dict(route=route, sampled=n, avg_queries=queries / n, max_queries=most, repeated=repeated)
+			for route, (n, queries, most, repeated) in self._requests.items()]
+		items.sort(key=lambda item: (-item['repeated'], -item['avg_queries']))
+		return items
+
+	def reset(self):
+		self._shapes.clear()
+		self._plans.clear()
+		self._requests.clear()
+
+query_stats = QueryStats()
+
+# 单个请求(或with作用域)内执行的查询，按语句形式计数，用于发现N+1查询
+# 查询缓存命中的不计入；gather()的并发查询共用同一个记录
+class QueryTrace(object):
+	def __init__(self):
+		self.count = 0
+		self.elapsed = 0.0
+		# 语句形式 ==> 次数
+		self.shapes = dict()
+
+	def add(self, shape, elapsed):
+		self.count += 1
+		self.elapsed += elapsed
+		self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+	# 计入另一个记录中的查询(如多个请求合并执行的查询)
+	def merge(self, other):
+		self.count += other.count
+		self.elapsed += other.elapsed
+		for shape, n in other.shapes.items():
+			self.shapes[shape] = self.shapes.get(shape, 0) + n
+
+	# 执行次数达到threshold的语句形式，按次数倒序返回[(语句形式, 次数)]
+	def repeated(self, threshold):
+		return sorted([(shape, n) for shape, n in self.shapes.items() if n >= threshold], key=lambda item: -item[1])
+
+_query_trace = contextvars.ContextVar('query_trace', default=None)
+
+# 在with语句内记录执行的查询：with orm.query_trace() as trace: ...
+class query_trace(object):
+	def __enter__(self):
+		self.trace = QueryTrace()
+		self._token = _query_trace.set(self.trace)
+		return self.trace
+
+	def __exit__(self, *exc):
+		_query_trace.reset(self._token)
+
+# 返回当前上下文的查询记录，没有时返回None
+def current_query_trace():
+	return _query_trace.get()
+
+# 把?占位符替换为驱动使用的占位符(MySQL为%s)，替换结果按sql缓存，ORM生成的语句只需替换一次
+# 缓存满后不再加入新语句(多为拼接了字面值的临时sql)，照常替换
+_prepared = dict()
+PREPARED_CACHE_SIZE = 2000
+_placeholder = '%s'
+
+def _prepare(sql):
+	prepared = _prepared.get(sql, None)
+	if prepared is None:
+		prepared = sql.replace('?', _placeholder)
+		if len(_prepared) < PREPARED_CACHE_SIZE:
+			_prepared[sql] = prepared
+	return prepared
+
 # 单独封装select
 # select语句，该协程封装的是查询事务，三个参数顺序：sql语句，sql语句中占位符的参数列表，查询数据的数量
-async def select(sql, args, size=None):
+# tuples为True时使用普通游标，每行返回元组，用于构建紧凑的Row
+async def select(sql, args, size=None, tuples=False):
+	rs, pending = _cache_lookup(sql, args, size, tuples)
+	if rs is not None:
+		return rs
 	log(sql, args)
-	# 获取游标，默认游标返回结果为字典,每一项都是字典，这里可指定元组的元素为字典通过aiomysql.DictCursor
-	async with __pool.get() as conn:  # 或--> with await __pool as conn:
+	start = time.time()
+	# 获取游标，默认游标返回结果为字典,每一项都是字典，这里可指定元组的元素为字典通过DictCursor
+	async with _connection(_read_pool) as conn:  # 或--> with await __pool as conn:
+		wait = time.time() - start
 		# 创建一个DictCursor类指针，!!返回dict形式的结果集!!
-		async with conn.cursor(aiomysql.DictCursor) as cur:
+		async with conn.cursor(_backend.Cursor if tuples else _backend.DictCursor) as cur:
 			# 调用游标的execute()方法来执行sql语句，execute()接受两个参数：sql语句(可包含占位符)，占位符对应的值，
 			# 使用该形式可以避免直接使用字符串拼接出来的sql注入攻击
 			# sql语句的占位符为？，mysql里为%s，做替换
-			await cur.execute(sql.replace('?', "%s"), args or ())
+			await cur.execute(_prepare(sql), args or ())
 			if size:
 				# size有值就获取对应数量的数据
 				rs = await cur.fetchmany(size)
 			else:
 				rs = await cur.fetchall()
-	logging.info('rows returned: %s' % len(rs))
+	query_stats.record(sql, args, wait, time.time() - start - wait, len(rs))
+	if pending:
+		query_cache.put(pending[0], pending[1], rs, pending[2])
 	return rs
 
+# 查找查询缓存，返回(缓存的结果, 保存结果时传给query_cache.put的(key, 表名, 版本))
+# 事务中可能读到未提交的数据、刚写入过的请求要读主库(读自己的写)，都不使用缓存，两者都为None
+# 表在read_your_writes秒内被写入过时，副本上可能还是写入前的数据，不缓存这次的结果
+def _cache_lookup(sql, args, size, tuples):
+	if not query_cache.enabled or _in_transaction() or _recently_wrote():
+		return None, None
+	key = query_cache.key(sql, args, size, tuples)
+	rs = query_cache.get(key)
+	if rs is not None:
+		return rs, None
+	tables = tuple(set(t.lower() for t in _RE_READ_TABLES.findall(sql)))
+	window = read_your_writes_window()
+	if window and query_cache.written_since(tables, window):
+		return None, None
+	return None, (key, tables, query_cache.versions(tables))
+
+# 一条只读查询及其结果的构建方式，供gather()/batch()使用，由Query.statement()生成
+# build把select返回的行转换为最终结果(Model实例、Row、数值等)
+class Statement(object):
+	def __init__(self, sql, args, build=None, size=None, tuples=False):
+		self.sql = sql
+		self.args = list(args) if args else []
+		self.build = build or (lambda rs: rs)
+		self.size = size
+		self.tuples = tuples
+
+	async def run(self):
+		return self.build(await select(self.sql, self.args, self.size, self.tuples))
+
+	def __repr__(self):
+		return '<Statement %s, %s>' % (self.sql, self.args)
+
+# 并发执行互不依赖的查询，每个查询各自从连接池获取连接，按传入顺序返回结果
+# 参数为协程(如Blog.findCount()、Query.all())或Statement；有一个失败时取消其余的
+# connection()/transaction()作用域内只有一个连接，改为依次执行
+async def gather(*queries):
+	aws = [q.run() if isinstance(q, Statement) else q for q in queries]
+	if _pinned.get() is not None:
+		return [await aw for aw in aws]
+	tasks = [asyncio.ensure_future(aw) for aw in aws]
+	try:
+		return list(await asyncio.gather(*tasks))
+	except BaseException:
+		for task in tasks:
+			task.cancel()
+		raise
+
+# 把多条只读查询拼成一次请求发送，在同一个连接上一次往返取回所有结果集，按传入顺序返回
+# 参数为Statement或Query(相当于Query.all())；命中查询缓存的语句不发送
+# 需要在数据库配置中开启multi_statements且后端支持(SQLite不支持)，否则退化为gather()
+async def batch(*statements):
+	statements = [s.statement() if isinstance(s, Query) else s for s in statements]
+	if not __multi_statements or len(statements) < 2:
+		return await gather(*statements)
+	results = [None] * len(statements)
+	todo = []
+	rows = 0
+	for i, s in enumerate(statements):
+		rs, pending = _cache_lookup(s.sql, s.args, s.size, s.tuples)
+		if rs is not None:
+			results[i] = s.build(rs)
+		else:
+			todo.append((i, s, pending))
+	if todo:
+		start = time.time()
+		async with _connection(_read_pool) as conn:
+			wait = time.time() - start
+			# 统一用普通游标，需要字典的结果集按description转换
+			async with conn.cursor(_backend.Cursor) as cur:
+				sql = ';\n'.join(cur.mogrify(_prepare(s.sql), s.args or None) for i, s, pending in todo)
+				log(sql)
+				await cur.execute(sql)
+				for n, (i, s, pending) in enumerate(todo):
+					if n > 0 and not await cur.nextset():
+						raise RuntimeError('Missing result set for statement %s: %s' % (n, s.sql))
+					rs = await cur.fetchall()
+					if s.size:
+						rs = rs[:s.size]
+					if not s.tuples:
+						names = [d[0] for d in cur.description]
+						rs = [dict(zip(names, r)) for r in rs]
+					if pending:
+						query_cache.put(pending[0], pending[1], rs, pending[2])
+					results[i] = s.build(rs)
+					rows += len(rs)
+		logging.info('statements batched: %s' % len(todo))
+		# 按?占位符形式记录，不同参数的同一组语句汇总为同一形式；合并后的语句无法EXPLAIN
+		query_stats.record(';\n'.join(s.sql for i, s, pending in todo), [a for i, s, pending in todo for a in (s.args or ())],
+			wait, time.time() - start - wait, rows, explain=False)
+	return results
+
+# 写操作淘汰依赖该表的缓存，执行前后各淘汰一次，避免执行期间的查询把旧数据写回缓存
+def _invalidate_cache(sql):
+	if query_cache.enabled:
+		m = _RE_WRITE_TABLE.match(sql)
+		if m:
+			table = m.group(1).lower()
+			query_cache.invalidate(table)
+			if _in_transaction():
+				# 提交时再淘汰一次
+				_pinned.get().tables.add(table)
+		else:
+			query_cache.clear()
+
+# 流式select：使用无缓冲的服务端游标(SSDictCursor)，每次fetch batch行并返回该批结果
+# 游标读完前会一直占用连接，所以总是单独从连接池获取连接，不使用connection()作用域固定的连接
+async def iter_select(sql, args, batch=None):
+	log(sql, args)
+	batch = batch or STREAM_BATCH_SIZE
+	start = time.time()
+	async with _read_pool().get() as conn:
+		wait = time.time() - start
+		async with conn.cursor(_backend.SSDictCursor) as cur:
+			await cur.execute(_prepare(sql), args or ())
+			total = 0
+			while True:
+				rs = await cur.fetchmany(batch)
+				if not rs:
+					break
+				total += len(rs)
+				yield rs
+	# 耗时包括调用者处理每批数据的时间
+	query_stats.record(sql, args, wait, time.time() - start - wait, total)
+
+# 流式查询默认每批读取的行数
+STREAM_BATCH_SIZE = 500
+
 # 封装insert，update，delete
 # 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，
 # 因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数
 async def execute(sql, args, autocommit=True):
 	log(sql, args)
-	with await __pool as conn:
+	_mark_write()
+	# 已在transaction()中时由事务作用域负责提交或回滚
+	autocommit = autocommit or _in_transaction()
+	_invalidate_cache(sql)
+	start = time.time()
+	async with _connection(_write_pool) as conn:
+		wait = time.time() - start
 		if not autocommit:
 			# 如果不是自动提交事务，需要手动启动
 			await conn.begin()
 		try:
-			async with conn.cursor(aiomysql.DictCursor) as cur:
-				await cur.execute(sql.replace('?', "%s"), args)
+			async with conn.cursor(_backend.DictCursor) as cur:
+				await cur.execute(_prepare(sql), args)
 				# 获取增删改影响的行数
 				affected = cur.rowcount
 			if not autocommit:
@@ -69,13 +653,449 @@ async def execute(sql, args, autocommit=True):
 				# 回滚，在执行commit()之前如果出现错误，就回滚到执行事务前的状态，以免影响数据库的完整性
 				await conn.rollback()
 			raise e
-		return affected
+	query_stats.record(sql, args, wait, time.time() - start - wait, affected)
+	_invalidate_cache(sql)
+	return affected
+
+# 在同一个连接上用同一条语句批量执行多组参数，返回影响的总行数
+async def executemany(sql, args_list, autocommit=True):
+	log(sql, '%s rows' % len(args_list))
+	_mark_write()
+	# 已在transaction()中时由事务作用域负责提交或回滚
+	autocommit = autocommit or _in_transaction()
+	_invalidate_cache(sql)
+	start = time.time()
+	async with _connection(_write_pool) as conn:
+		wait = time.time() - start
+		if not autocommit:
+			await conn.begin()
+		try:
+			async with conn.cursor(_backend.DictCursor) as cur:
+				await cur.executemany(_prepare(sql), args_list)
+				affected = cur.rowcount
+			if not autocommit:
+				await conn.commit()
+		except BaseException as e:
+			if not autocommit:
+				await conn.rollback()
+			raise e
+	query_stats.record(sql, '%s rows' % len(args_list), wait, time.time() - start - wait, affected)
+	_invalidate_cache(sql)
+	return affected
+
+# saveMany/updateMany默认每批的行数
+BATCH_CHUNK_SIZE = 500
+
+
+# 行数计数器：缓存各表的总行数和登记过的过滤条件的行数，代替每个列表请求都执行一次count(id)
+# 启动时预先统计，Model.save()/remove()时增减，后台定时与数据库校准
+# 未登记的过滤条件(如每篇日志的评论数)直接查询数据库，不缓存，避免每个参数值都留下一项并在校准时逐一count
+class Counters(object):
+	def __init__(self):
+		# (表名, where, args) ==> 行数
+		self._counts = dict()
+		# (表名, where, args) ==> Model类，校准时使用
+		self._models = dict()
+		# 登记的带过滤条件的key
+		self._registered = set()
+		# 表名 ==> 写入次数，查询期间表有写入时不保存查询结果，避免覆盖已调整的计数
+		self._versions = dict()
+		self._task = None
+
+	async def get(self, model, where=None, args=None):
+		key = self._key(model, where, args)
+		num = self._counts.get(key, None)
+		if num is None:
+			if where and key not in self._registered:
+				return await self._query(model, key)
+			num = await self._count(model, key)
+		return num
+
+	# 登记需要缓存的带过滤条件的计数
+	def register(self, model, where, args=None):
+		self._registered.add(self._key(model, where, args))
+
+	def _key(self, model, where, args):
+		return (model.__table__, where, tuple(args) if args else ())
+
+	def _query(self, model, key):
+		return model.findNumber('count(`%s`)' % model.__primary_key__, key[1], list(key[2]))
+
+	async def _count(self, model, key):
+		version = self._versions.get(key[0], 0)
+		num = await self._query(model, key)
+		if self._versions.get(key[0], 0) == version:
+			self._counts[key] = num
+			self._models[key] = model
+		return num
+
+	# 启动时统计各表的总行数
+	async def seed(self, *models):
+		for model in models:
+			await self.get(model)
+
+	# 插入(delta=1)或删除(delta=-1)一行后调整计数，无法判断是否满足过滤条件的计数直接丢弃
+	def adjust(self, instance, delta):
+		table = instance.__table__
+		self._versions[table] = self._versions.get(table, 0) + 1
+		for key in list(self._counts.keys()):
+			if key[0] != table:
+				continue
+			matched = _match_filter(key[1], key[2], instance)
+			if matched is None:
+				self._discard(key)
+			elif matched:
+				self._counts[key] += delta
+
+	# 更新可能改变过滤条件列的值，丢弃该表带过滤条件的计数
+	def invalidate(self, table):
+		self._versions[table] = self._versions.get(table, 0) + 1
+		for key in list(self._counts.keys()):
+			if key[0] == table and key[1]:
+				self._discard(key)
+
+	def _discard(self, key):
+		self._counts.pop(key, None)
+		self._models.pop(key, None)
+
+	# 与数据库校准所有已缓存的计数
+	# 副本有复制延迟时固定使用一个主库连接，避免用副本上延迟的行数覆盖刚调整的计数
+	async def reconcile(self):
+		if read_your_writes_window():
+			async with connection():
+				await self._reconcile()
+		else:
+			await self._reconcile()
+
+	async def _reconcile(self):
+		for key, model in list(self._models.items()):
+			await self._count(model, key)
+
+	# 启动后台定时校准任务，使用batch通道，全表count不占用读者请求的连接
+	def start(self, interval=300):
+		async def reconcile_forever():
+			while True:
+				await asyncio.sleep(interval)
+				try:
+					with lane('batch'):
+						await self.reconcile()
+				except Exception as e:
+					logging.exception(e)
+		if self._task is None:
+			self._task = asyncio.ensure_future(reconcile_forever())
+
+_RE_EQ_FILTER = re.compile(r'^`?(\w+)`?\s*=\s*\?$')
+
+# 判断实例是否满足形如'a=? and b=?'的过滤条件，条件无法解析时返回None
+def _match_filter(where, args, instance):
+	if not where:
+		return True
+	conds = re.split(r'\s+and\s+', where.strip(), flags=re.I)
+	if len(conds) != len(args):
+		return None
+	for cond, arg in zip(conds, args):
+		m = _RE_EQ_FILTER.match(cond.strip())
+		if not m or m.group(1) not in instance.__mappings__:
+			return None
+		if instance.getValue(m.group(1)) != arg:
+			return False
+	return True
+
+counters = Counters()
 
+# 插入或删除一行后调整计数；在事务中时记在_Pinned上，等提交后再调整
+# 记录由实例的值新建的副本(不复制修改记录等状态)，提交前修改实例不影响按过滤条件的调整
+def _adjust_count(instance, delta):
+	pinned = _pinned.get()
+	if pinned is not None and pinned.in_transaction:
+		pinned.adjustments.append((type(instance)(**instance), delta))
+	else:
+		counters.adjust(instance, delta)
+
+# 请求级的identity map：同一请求内按主键find到的实例只查询一次数据库
+# 通过contextvars绑定到当前请求的task上，未绑定时find照常查询数据库
+class IdentityMap(object):
+	def __init__(self):
+		# (表名, 主键) ==> Model实例
+		self._instances = dict()
+		self.hits = 0
+		self.misses = 0
+
+	# fields为需要的字段，缓存的实例缺少字段时视为未命中
+	def get(self, cls, primarykey, fields):
+		instance = self._instances.get((cls.__table__, primarykey), None)
+		if instance is not None and all(f in instance for f in fields):
+			self.hits += 1
+			return instance
+		self.misses += 1
+		return None
+
+	def put(self, instance):
+		self._instances[(instance.__table__, instance.getValue(instance.__primary_key__))] = instance
+
+	def discard(self, instance):
+		self._instances.pop((instance.__table__, instance.getValue(instance.__primary_key__)), None)
+
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+# 为当前上下文绑定一个新的identity map，with语句结束后解除绑定
+class identity_map(object):
+	def __enter__(self):
+		self.map = IdentityMap()
+		self._token = _identity_map.set(self.map)
+		return self.map
+
+	def __exit__(self, *exc):
+		_identity_map.reset(self._token)
+
+# 返回当前上下文绑定的identity map，没有时返回None
+def current_identity_map():
+	return _identity_map.get()
+
+# 合并并发的find调用：同一事件循环周期(或FIND_BATCH_WINDOW秒)内的find合并为一条where id in (...)查询
+FIND_BATCH = True
+FIND_BATCH_WINDOW = 0
+FIND_BATCH_SIZE = 100
+
+# 每个通道一个FindBatcher，合并的查询在新的上下文中执行，使用该通道的连接，不继承第一个调用者的其它状态
+# 查询计入每个等待结果的调用者的查询记录(query_trace)
+class FindBatcher(object):
+	# window、maxsize默认使用创建时FIND_BATCH_WINDOW、FIND_BATCH_SIZE的值
+	def __init__(self, cls, window=None, maxsize=None, lane_name=None):
+		self._cls = cls
+		self._window = FIND_BATCH_WINDOW if window is None else window
+		self._maxsize = FIND_BATCH_SIZE if maxsize is None else maxsize
+		self._lane = lane_name or current_lane()
+		self._loop = asyncio.get_event_loop()
+		# 主键 ==> 等待该行数据的future，同一主键的调用共用一个future
+		self._pending = dict()
+		# 等待结果的调用者的查询记录：id ==> QueryTrace
+		self._traces = dict()
+		self._handle = None
+
+	# 返回一个future，结果为该主键对应的行(dict)，不存在时为None
+	def load(self, primarykey):
+		trace = _query_trace.get()
+		if trace is not None:
+			self._traces[id(trace)] = trace
+		fut = self._pending.get(primarykey, None)
+		if fut is None:
+			fut = self._loop.create_future()
+			self._pending[primarykey] = fut
+			if len(self._pending) >= self._maxsize:
+				self._dispatch()
+			elif self._handle is None:
+				if self._window > 0:
+					self._handle = self._loop.call_later(self._window, self._dispatch)
+				else:
+					self._handle = self._loop.call_soon(self._dispatch)
+		return fut
+
+	def _dispatch(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		pending, self._pending = self._pending, dict()
+		traces, self._traces = list(self._traces.values()), dict()
+		if pending:
+			contextvars.Context().run(asyncio.ensure_future, self._run(pending, traces))
+
+	async def _run(self, pending, traces):
+		try:
+			with lane(self._lane), query_trace() as trace:
+				rows = await self._cls._findRows(list(pending.keys()))
+		except Exception as e:
+			for fut in pending.values():
+				if not fut.done():
+					fut.set_exception(e)
+			return
+		finally:
+			for t in traces:
+				t.merge(trace)
+		for primarykey, fut in pending.items():
+			if not fut.done():
+				fut.set_result(rows.get(str(primarykey), None))
+
+# (Model类, 通道) ==> FindBatcher，不同通道的find不合并，后台或管理请求的查询不会拖慢读者请求
+_batchers = dict()
+
+# 设置改变后重新创建，修改FIND_BATCH_WINDOW/FIND_BATCH_SIZE立即生效
+def _batcher(cls):
+	key = (cls, current_lane())
+	batcher = _batchers.get(key, None)
+	if batcher is None or batcher._loop is not asyncio.get_event_loop() or (batcher._window, batcher._maxsize) != (FIND_BATCH_WINDOW, FIND_BATCH_SIZE):
+		batcher = _batchers[key] = FindBatcher(cls, lane_name=key[1])
+	return batcher
 
 # # 创建占位符，用于insert，update，delete语句
 # def create_args_string(num):
 # 	return ','.join(['?']*num)
 
+# 紧凑的结果行：只有__slots__的对象，不像Model(dict)那样每行一个dict，直接由元组游标的行按位置构建
+# 用于只读的结果，不能保存回数据库；为了构建速度没有禁止给字段赋值，每次查询都构建新的Row，修改不影响其它调用者
+# 支持属性访问和row['name']，需要时才转换为dict，json.dumps的default=lambda obj: obj.__dict__可直接序列化
+class Row(object):
+	__slots__ = ()
+	_fields = ()
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def get(self, key, default=None):
+		return getattr(self, key, default)
+
+	@property
+	def __dict__(self):
+		return self._asdict()
+
+	def _asdict(self):
+		return dict(zip(self._fields, map(self.__getitem__, self._fields)))
+
+	def __repr__(self):
+		return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self._fields))
+
+# 按字段生成Row的子类，__init__按位置赋值，用cls(*row)构建
+def make_row_class(name, fields):
+	fields = tuple(fields)
+	src = 'def __init__(self, %s):\n%s' % (', '.join(fields), ''.join('\tself.%s = %s\n' % (f, f) for f in fields))
+	namespace = dict()
+	exec(src, namespace)
+	return type(name, (Row,), dict(__slots__=fields, _fields=fields, __init__=namespace['__init__']))
+
+# 组合式查询：过滤条件、排序、limit、投影，每次调用返回新的Query，可以复用部分条件
+# 同一形式(字段、条件列和运算符、排序、limit方式)的查询只编译一次sql，之后只绑定参数
+_QUERY_OPS = ('=', '!=', '<', '<=', '>', '>=', 'like', 'in')
+
+class Query(object):
+	def __init__(self, model, fields=None):
+		self._model = model
+		self._fields = tuple(fields) if fields else None
+		# (列名, 运算符, in的参数个数)
+		self._filters = ()
+		self._args = ()
+		# (列名, 是否倒序)
+		self._order = ()
+		self._limit = ()
+		self._compact = False
+
+	def _copy(self, **kw):
+		q = Query.__new__(Query)
+		q.__dict__.update(self.__dict__)
+		q.__dict__.update(kw)
+		return q
+
+	# 等值条件：where(blog_id=id)
+	def where(self, **kw):
+		q = self
+		for column, value in kw.items():
+			q = q.filter(column, '=', value)
+		return q
+
+	# 任意条件：filter('created_at', '<', t)，'in'的值为列表
+	def filter(self, column, op, value):
+		op = op.lower()
+		if op not in _QUERY_OPS:
+			raise ValueError('Invalid operator: %s' % op)
+		if column not in self._model.__mappings__:
+			raise ValueError('Invalid field for %s: %s' % (self._model.__name__, column))
+		if op == 'in':
+			values = tuple(value)
+			if not values:
+				raise ValueError('Empty value list for in: %s' % column)
+			return self._copy(_filters=self._filters + ((column, op, len(values)),), _args=self._args + values)
+		return self._copy(_filters=self._filters + ((column, op, 0),), _args=self._args + (value,))
+
+	# 排序：orderBy('-created_at', 'id')，-表示倒序
+	def orderBy(self, *columns):
+		order = []
+		for column in columns:
+			desc = column.startswith('-')
+			column = column.lstrip('-')
+			if column not in self._model.__mappings__:
+				raise ValueError('Invalid field for %s: %s' % (self._model.__name__, column))
+			order.append((column, desc))
+		return self._copy(_order=tuple(order))
+
+	def limit(self, limit, offset=None):
+		return self._copy(_limit=(limit,) if offset is None else (offset, limit))
+
+	def fields(self, *fields):
+		return self._copy(_fields=fields or None)
+
+	def compact(self, compact=True):
+		return self._copy(_compact=compact)
+
+	def _where(self):
+		conds = []
+		for column, op, num in self._filters:
+			if op == 'in':
+				conds.append('`%s` in (%s)' % (column, ','.join(['?'] * num)))
+			else:
+				conds.append('`%s`%s?' % (column, op if op != 'like' else ' like '))
+		return ' and '.join(conds)
+
+	# 编译为驱动可以直接执行的sql，按查询形式缓存在Model上
+	def compile(self):
+		model = self._model
+		projection = model._projection(self._fields)
+		shape = ('query', projection, self._filters, self._order, len(self._limit))
+		sql = model.__query_cache__.get(shape, None)
+		if sql is None:
+			sql = [model._select(projection)]
+			if self._filters:
+				sql.append('where')
+				sql.append(self._where())
+			if self._order:
+				sql.append('order by')
+				sql.append(', '.join('`%s`%s' % (c, ' desc' if d else '') for c, d in self._order))
+			if self._limit:
+				sql.append('limit')
+				sql.append(','.join(['?'] * len(self._limit)))
+			sql = ' '.join(sql)
+			# 预先替换好占位符
+			_prepare(sql)
+			model.__query_cache__[shape] = sql
+		return sql, list(self._args + self._limit)
+
+	async def all(self):
+		sql, args = self.compile()
+		return await self._model._fetch(sql, args, self._fields, self._compact)
+
+	# 生成供gather()/batch()执行的Statement：kind为'all'、'first'或'count'
+	# 'count'直接查询数据库，不使用计数器
+	def statement(self, kind='all'):
+		model = self._model
+		if kind == 'all':
+			sql, args = self.compile()
+			fields, compact = self._fields, self._compact
+			return Statement(sql, args, lambda rs: model._build(rs, fields, compact), tuples=compact)
+		if kind == 'first':
+			s = self.limit(1).statement()
+			build = s.build
+			s.build = lambda rs: (build(rs) or [None])[0]
+			return s
+		if kind == 'count':
+			sql = 'select count(`%s`) __num__ from `%s`' % (model.__primary_key__, model.__table__)
+			if self._filters:
+				sql = '%s where %s' % (sql, self._where())
+			return Statement(sql, self._args, lambda rs: rs[0]['__num__'] if rs else 0, size=1)
+		raise ValueError('Invalid statement kind: %s' % kind)
+
+	async def first(self):
+		rs = await self.limit(1).all()
+		return rs[0] if rs else None
+
+	# 行数，没有过滤条件或条件登记过时使用计数器缓存
+	async def count(self):
+		return await counters.get(self._model, self._where() or None, list(self._args))
+
+	def __aiter__(self):
+		sql, args = self.compile()
+		return self._model._stream(sql, args).__aiter__()
+
 # 定义Metaclass元类
 class ModelMetaclass(type):
 	def __new__(cls, name, bases, attrs):
@@ -89,6 +1109,8 @@ class ModelMetaclass(type):
 		mappings = dict()
 		# 保存除主键外的属性名
 		fields = []
+		# 延迟加载的字段
+		deferred = []
 		# 主键
 		primarykey = None
 		for k, v in attrs.items():
@@ -105,6 +1127,8 @@ class ModelMetaclass(type):
 				else:
 					#保存非主键的列名
 					fields.append(k)
+					if getattr(v, 'deferred', False):
+						deferred.append(k)
 		if not primarykey:
 			raise BaseException('primary key not found')
 		for k in mappings.keys():
@@ -117,6 +1141,30 @@ class ModelMetaclass(type):
 		attrs['__table__'] = tableName
 		attrs['__fields__'] = fields
 		attrs['__primary_key__'] = primarykey
+		attrs['__deferred__'] = deferred
+		# 索引定义：(索引名, 列名元组, 是否唯一)，单列索引来自Field(index=True, unique=True)，
+		# 组合索引来自类属性__indexes__/__unique_indexes__，如 __indexes__ = [('blog_id', 'created_at')]
+		indexes = []
+		for k in [primarykey] + fields:
+			v = mappings[k]
+			if getattr(v, 'index', False) and not v.primary_key:
+				indexes.append(((k,), v.unique))
+		indexes.extend((tuple(c), False) for c in attrs.get('__indexes__', ()))
+		indexes.extend((tuple(c), True) for c in attrs.get('__unique_indexes__', ()))
+		for columns, unique in indexes:
+			for c in columns:
+				if c not in mappings:
+					raise BaseException('Index field not found: %s' % c)
+		attrs['__index_defs__'] = [('%s_%s_%s' % ('uniq' if unique else 'idx', tableName, '_'.join(columns)), columns, unique) for columns, unique in indexes]
+		# 按投影字段缓存生成的select/update语句，key为字段名元组
+		attrs['__select_cache__'] = dict()
+		attrs['__update_cache__'] = dict()
+		# 多行insert语句，key为行数
+		attrs['__insert_cache__'] = dict()
+		# 按查询的列缓存生成的Row类
+		attrs['__row_cache__'] = dict()
+		# 按查询形式缓存生成的select语句
+		attrs['__query_cache__'] = dict()
 		# 构造默认的select，insert，update，delete语句，其中添加的反引号``,是为了避免与sql关键字冲突的,否则sql语句会执行出错
 		# -------------------eg：select id from user;
 		attrs['__select__'] = 'select `%s`, %s from `%s`' % (primarykey, ','.join(escaped_fields), tableName)
@@ -131,17 +1179,47 @@ class ModelMetaclass(type):
 class Model(dict, metaclass = ModelMetaclass):
 	def __init__(self, **kw):
 		# super的另一种写法
-		super(Model, self).__init__(self, **kw)
+		super(Model, self).__init__(**kw)
 	
 	def __getattr__(self, key):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__deferred__:
+				raise AttributeError('Deferred field not loaded: %s, call load() first' % key)
 			raise AttributeError('Model object has no attribute: %s' % key)
 
 	def __setattr__(self, key, value):
 		self[key] = value
 
+	# 从数据库加载的实例记录此后修改过的字段，update()只写这些字段；
+	# 自己构造的实例为None，update()写入所有已赋值的字段
+	_dirty = None
+
+	def __setitem__(self, key, value):
+		dirty = self._dirty
+		if dirty is not None and key in self.__mappings__ and (key not in self or dict.__getitem__(self, key) != value):
+			dirty.add(key)
+		dict.__setitem__(self, key, value)
+
+	# 由查询结果构建实例，此时没有修改过的字段
+	@classmethod
+	def _fromRow(cls, row):
+		instance = cls(**row)
+		object.__setattr__(instance, '_dirty', set())
+		return instance
+
+	# 已与数据库一致，清空修改记录
+	def _clean(self):
+		object.__setattr__(self, '_dirty', set())
+
+	# update()要写入的字段
+	def _changedFields(self):
+		dirty = self._dirty
+		if dirty is None:
+			return tuple(f for f in self.__fields__ if f in self)
+		return tuple(f for f in self.__fields__ if f in dirty)
+
 	def getValue(self, key):
 		# 继承父类dict的内建函数getattr()
 		return getattr(self, key, None)
@@ -156,44 +1234,218 @@ class Model(dict, metaclass = ModelMetaclass):
 				logging.debug('use default value for %s: %s' % (key, str(value)))
 		return value
 
+	# 根据投影字段生成select语句，主键总是会被查询，结果按字段元组缓存
+	@classmethod
+	def _select(cls, fields=None):
+		key = cls._projection(fields)
+		sql = cls.__select_cache__.get(key, None)
+		if sql is None:
+			sql = 'select %s from `%s`' % (','.join(['`%s`' % f for f in cls._columns(key)]), cls.__table__)
+			cls.__select_cache__[key] = sql
+		return sql
+
+	@classmethod
+	def _projection(cls, fields=None):
+		if fields is None:
+			fields = [f for f in cls.__fields__ if f not in cls.__deferred__]
+		return tuple(fields)
+
+	# 投影实际查询的列及顺序：主键在前
+	@classmethod
+	def _columns(cls, fields):
+		for f in fields:
+			if f not in cls.__mappings__:
+				raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+		return [cls.__primary_key__] + [f for f in fields if f != cls.__primary_key__]
+
+	# 该投影对应的紧凑Row类
+	@classmethod
+	def _row(cls, fields=None):
+		key = cls._projection(fields)
+		row = cls.__row_cache__.get(key, None)
+		if row is None:
+			row = cls.__row_cache__[key] = make_row_class('%sRow' % cls.__name__, cls._columns(key))
+		return row
+
+	# 执行查询并构建结果：compact为True时返回Row，否则返回Model实例
+	@classmethod
+	async def _fetch(cls, sql, args, fields=None, compact=False):
+		return cls._build(await select(sql, args, tuples=compact), fields, compact)
+
+	# compact为True时rs为元组，否则为字典
+	@classmethod
+	def _build(cls, rs, fields=None, compact=False):
+		if compact:
+			row = cls._row(fields)
+			return [row(*r) for r in rs]
+		return [cls._fromRow(r) for r in rs]
+
+	# 只更新实例中已加载的字段，避免把未加载的延迟字段写成NULL
+	@classmethod
+	def _update(cls, fields):
+		key = tuple(fields)
+		if key == tuple(cls.__fields__):
+			return cls.__update__
+		sql = cls.__update_cache__.get(key, None)
+		if sql is None:
+			sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(map(lambda f: '`%s`=?' % f, key)), cls.__primary_key__)
+			cls.__update_cache__[key] = sql
+		return sql
+
+	# 由__insert__模板生成一次插入num行的insert语句
+	@classmethod
+	def _insertMany(cls, num):
+		sql = cls.__insert_cache__.get(num, None)
+		if sql is None:
+			row = '(%s)' % ','.join(['?'] * (len(cls.__fields__) + 1))
+			sql = cls.__insert__ + (', ' + row) * (num - 1)
+			cls.__insert_cache__[num] = sql
+		return sql
+
 	# 类方法有类变量cls传入，从而可以用cls做一些相关的处理。
 	# 有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。 
+	# compact=True时返回只读的紧凑Row，适合只读的列表页
 	@classmethod# 新语法，该装饰器用于把类里面定义的方法声明为该类的类方法
 	async def findAll(cls, where=None, args=None, **kw):
-		if not args:
-			args = []
-		# 有子类方法继承时,调用此类方法,传入的类变量cls是子类,而非父类
-		sql = [cls.__select__] 
-		if where: 
-			sql.append('where')
-			sql.append(where)
+		sql, args = cls._findAllSql(where, args, **kw)
+		# 将返回的结果迭代生成类的实例，返回的都是实例对象, 而非仅仅是数据
+		return await cls._fetch(sql, args, kw.get('fields', None), kw.get('compact', False))
+
+	# 流式查询：用服务端游标每次读取batch行，逐个返回实例，内存占用与结果集大小无关
+	# 用法：async for comment in Comment.stream(orderBy='created_at desc'): ...
+	@classmethod
+	async def stream(cls, where=None, args=None, batch=STREAM_BATCH_SIZE, **kw):
+		sql, args = cls._findAllSql(where, args, **kw)
+		async for instance in cls._stream(sql, args, batch):
+			yield instance
+
+	@classmethod
+	async def _stream(cls, sql, args, batch=STREAM_BATCH_SIZE):
+		async for rs in iter_select(sql, args, batch):
+			for r in rs:
+				yield cls._fromRow(r)
+
+	# 生成findAll/stream的sql语句和参数
+	@classmethod
+	def _findAllSql(cls, where=None, args=None, **kw):
+		args = list(args) if args else []
+		# fields指定要查询的字段，不指定时查询除延迟字段外的所有字段
+		projection = cls._projection(kw.get('fields', None))
 		orderBy = kw.get('orderBy', None)
-		if orderBy:
-			sql.append('order by')
-			sql.append(orderBy)
 		limit = kw.get('limit', None)
 		if limit:
-			sql.append('limit')
 			if isinstance(limit, int):
-				sql.append('?')
 				args.append(limit)
 			elif isinstance(limit, tuple) and len(limit)==2:
-				sql.append('?, ?')
 				args.extend(limit)
 			else:
-				raise('Invalid limit value: %s' % str(limit))
-		rs = await select(' '.join(sql), args)	
-		# 将返回的结果迭代生成类的实例，返回的都是实例对象, 而非仅仅是数据
-		return [cls(**r) for r in rs]
+				raise ValueError('Invalid limit value: %s' % str(limit))
+		# 同样形式的查询只拼接一次sql
+		shape = (projection, where, orderBy, isinstance(limit, tuple) and 2 or (1 if limit else 0))
+		sql = cls.__query_cache__.get(shape, None)
+		if sql is None:
+			# 有子类方法继承时,调用此类方法,传入的类变量cls是子类,而非父类
+			sql = [cls._select(projection)]
+			if where: 
+				sql.append('where')
+				sql.append(where)
+			if orderBy:
+				sql.append('order by')
+				sql.append(orderBy)
+			if limit:
+				sql.append('limit')
+				sql.append('?, ?' if shape[3] == 2 else '?')
+			sql = cls.__query_cache__[shape] = ' '.join(sql)
+		return sql, args
+
+	# 组合式查询：Blog.query('name', 'summary').where(user_id=uid).orderBy('-created_at').limit(10).all()
+	@classmethod
+	def query(cls, *fields):
+		return Query(cls, fields or None)
+
+	# 键集(seek)分页：按(orderKey, 主键)倒序排列，从游标位置开始取limit条，避免大offset时扫描并丢弃前面的行
+	# seek为(方向, orderKey值, 主键值)：'next'取游标之后(更旧)的数据，'prev'取游标之前(更新)的数据
+	@classmethod
+	async def findSeek(cls, where=None, args=None, seek=None, limit=10, orderKey='created_at', **kw):
+		args = list(args) if args else []
+		fields = kw.get('fields', None)
+		if fields is not None and orderKey not in fields:
+			# 生成游标需要orderKey的值
+			fields = tuple(fields) + (orderKey,)
+		sql = [cls._select(fields)]
+		conds = []
+		if where:
+			conds.append('(%s)' % where)
+		order = 'desc'
+		if seek:
+			direction, value, primarykey = seek
+			op = '<' if direction == 'next' else '>'
+			if direction != 'next':
+				order = 'asc'
+			conds.append('(`%s`%s? or (`%s`=? and `%s`%s?))' % (orderKey, op, orderKey, cls.__primary_key__, op))
+			args.extend([value, value, primarykey])
+		if conds:
+			sql.append('where')
+			sql.append(' and '.join(conds))
+		sql.append('order by `%s` %s, `%s` %s' % (orderKey, order, cls.__primary_key__, order))
+		sql.append('limit ?')
+		args.append(limit)
+		items = await cls._fetch(' '.join(sql), args, fields, kw.get('compact', False))
+		if order == 'asc':
+			# 向前翻页时是正序查询的，翻转回倒序
+			items.reverse()
+		return items
+
+	# 按主键批量查询，返回{str(主键): 行}，主键过多时分多次查询
+	@classmethod
+	async def _findRows(cls, primarykeys, fields=None):
+		select_sql = cls.__select__ if fields is None else cls._select(fields)
+		rows = dict()
+		for i in range(0, len(primarykeys), FIND_BATCH_SIZE):
+			chunk = primarykeys[i:i+FIND_BATCH_SIZE]
+			sql = '%s where `%s` in (%s)' % (select_sql, cls.__primary_key__, ','.join(['?'] * len(chunk)))
+			for r in await select(sql, list(chunk)):
+				rows[str(r[cls.__primary_key__])] = r
+		return rows
+
+	# 按主键列表查询，结果与primarykeys一一对应，不存在的为None
+	@classmethod
+	async def findMany(cls, primarykeys, fields=None):
+		primarykeys = list(primarykeys)
+		rows = await cls._findRows(list(set(primarykeys)), fields)
+		results = []
+		for primarykey in primarykeys:
+			r = rows.get(str(primarykey), None)
+			results.append(cls._fromRow(r) if r is not None else None)
+		return results
 
 	# 根据主键查找数据库
+	# find默认查询包括延迟字段在内的全部字段，详情页需要完整数据
 	@classmethod
-	async def find(cls,primarykey):
-		sql = '%s where `%s`=?' % (cls.__select__, cls.__primary_key__)
-		rs = await select(sql, [primarykey], 1)
-		if len(rs) == 0:
-			return None
-		return cls(**rs[0])
+	async def find(cls, primarykey, fields=None):
+		imap = _identity_map.get()
+		if imap is not None:
+			instance = imap.get(cls, primarykey, cls.__fields__ if fields is None else fields)
+			if instance is not None:
+				return instance
+		# 刚写入过或在connection()/transaction()作用域内时不合并：
+		# 合并查询在第一个调用者的上下文中执行，可能被路由到副本或用到别人的固定连接
+		if fields is None and FIND_BATCH and not _recently_wrote() and _pinned.get() is None:
+			# 与同一时间的其它find合并查询，每个调用者各自得到一个新实例
+			# shield避免某个调用者被取消时影响共用同一future的其它调用者
+			row = await asyncio.shield(_batcher(cls).load(primarykey))
+			if row is None:
+				return None
+			instance = cls._fromRow(row)
+		else:
+			sql = '%s where `%s`=?' % (cls.__select__ if fields is None else cls._select(fields), cls.__primary_key__)
+			rs = await select(sql, [primarykey], 1)
+			if len(rs) == 0:
+				return None
+			instance = cls._fromRow(rs[0])
+		if imap is not None:
+			imap.put(instance)
+		return instance
 
 	@classmethod
 	async def findNumber(cls, selectField, where=None, args=None):
@@ -210,31 +1462,119 @@ class Model(dict, metaclass = ModelMetaclass):
 		# fetchmany()返回列表结果，用索引取出。又因为Dictcursor，值用key取出。
 		return rs[0]['__num__']
 
+	# 行数：没有过滤条件或条件登记过(counters.register)时从计数器中获取，已缓存时不访问数据库
+	@classmethod
+	async def findCount(cls, where=None, args=None):
+		return await counters.get(cls, where, args)
+
+	# 批量保存：每chunkSize个实例拼成一条多行insert语句，返回每批影响的行数
+	@classmethod
+	async def saveMany(cls, instances, chunkSize=BATCH_CHUNK_SIZE, autocommit=True):
+		results = []
+		# 所有批次固定使用同一个连接
+		async with connection():
+			for i in range(0, len(instances), chunkSize):
+				chunk = instances[i:i+chunkSize]
+				args = []
+				for instance in chunk:
+					instance._discardIdentity()
+					args.extend(map(instance.getValueOrDefault, cls.__fields__))
+					args.append(instance.getValueOrDefault(cls.__primary_key__))
+				rows = await execute(cls._insertMany(len(chunk)), args, autocommit)
+				if rows != len(chunk):
+					logging.warn('failed to insert records: affected rows: %s of %s' % (rows, len(chunk)))
+				else:
+					for instance in chunk:
+						_adjust_count(instance, 1)
+						instance._clean()
+				results.append(rows)
+		return results
+
+	# 批量更新：已加载字段相同的实例每chunkSize个用executemany在一个连接上执行，返回每批影响的行数
+	@classmethod
+	async def updateMany(cls, instances, chunkSize=BATCH_CHUNK_SIZE, autocommit=True):
+		groups = dict()
+		for instance in instances:
+			instance._discardIdentity()
+			fields = instance._changedFields()
+			if fields:
+				groups.setdefault(fields, []).append(instance)
+		results = []
+		async with connection():
+			for fields, group in groups.items():
+				for i in range(0, len(group), chunkSize):
+					chunk = group[i:i+chunkSize]
+					args_list = [list(map(instance.getValue, fields)) + [instance.getValue(cls.__primary_key__)] for instance in chunk]
+					rows = await executemany(cls._update(fields), args_list, autocommit)
+					if rows != len(chunk):
+						logging.warn('failed to update records: affected rows: %s of %s' % (rows, len(chunk)))
+					for instance in chunk:
+						instance._clean()
+					results.append(rows)
+		if results:
+			counters.invalidate(cls.__table__)
+		return results
+
 	# 以下都是对象方法，所以可以不用传参数，方法内部可以使用该对象的所有属性
+	# 加载尚未查询的字段（如延迟字段），不指定时加载全部未加载的字段
+	async def load(self, *fields):
+		missing = [f for f in (fields or self.__fields__) if f not in self]
+		if not missing:
+			return self
+		sql = '%s where `%s`=?' % (self._select(missing), self.__primary_key__)
+		rs = await select(sql, [self.getValue(self.__primary_key__)], 1)
+		if len(rs) == 0:
+			return None
+		for k in missing:
+			dict.__setitem__(self, k, rs[0][k])
+		return self
+
+	# 写操作使当前请求identity map中的对应实例失效
+	def _discardIdentity(self):
+		imap = _identity_map.get()
+		if imap is not None:
+			imap.discard(self)
+
 	# 保存实例到数据库
 	async def save(self):
+		self._discardIdentity()
 		args = list(map(self.getValueOrDefault, self.__fields__))
 		primarykey = self.getValueOrDefault(self.__primary_key__)
 		args.append(primarykey)
 		rows = await execute(self.__insert__, args)
 		if rows != 1:
 			logging.warn('failed to insert record: affected rows: %s' % rows)
+		else:
+			_adjust_count(self, 1)
+			self._clean()
 
 	# 更新数据库资料
 	async def update(self):
-		args = list(map(self.getValue, self.__fields__))
+		self._discardIdentity()
+		# 只写入修改过的字段，没有修改时不访问数据库
+		fields = self._changedFields()
+		if not fields:
+			logging.debug('nothing to update: %s' % self.getValue(self.__primary_key__))
+			return
+		args = list(map(self.getValue, fields))
 		primarykey = self.getValue(self.__primary_key__)
 		args.append(primarykey)
-		rows = await execute(self.__update__, args)
+		rows = await execute(self._update(fields), args)
+		counters.invalidate(self.__table__)
 		if rows != 1:
 			logging.warn('failed to update record: affected rows: %s' % rows)
+		else:
+			self._clean()
 
 	# 删除数据
 	async def remove(self):
+		self._discardIdentity()
 		args = [self.getValue(self.__primary_key__)]
 		rows = await execute(self.__delete__, args)
 		if rows != 1:
 			logging.warn('failed to remove by primary key: affected rows: %s' % rows) 
+		else:
+			_adjust_count(self, -1)
 
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# 按优先级通道(lane)分配连接池的连接，避免管理页面、后台任务的突发查询占满连接池，拖慢读者访问的页面
+# 每个通道有预留的连接数，只有本通道可以使用；其余为共享连接，有多个通道在等待时按权重轮流分配(加权轮询)
+# 当前通道由contextvars保存，可以按路由(见app.py的lane_factory)或在代码中用 with lane('batch'): 设置
+
+import asyncio, contextlib, contextvars, logging, time
+from collections import deque
+
+DEFAULT_LANE = 'interactive'
+
+_lane = contextvars.ContextVar('pool_lane', default=DEFAULT_LANE)
+
+# 在with语句内使用指定的通道
+@contextlib.contextmanager
+def lane(name):
+	token = _lane.set(name)
+	try:
+		yield
+	finally:
+		_lane.reset(token)
+
+def current_lane():
+	return _lane.get()
+
+class _Lane(object):
+	def __init__(self, name, reserved=0, weight=1):
+		self.name = name
+		self.reserved = reserved
+		self.weight = weight
+		# 正在使用的预留连接数和共享连接数
+		self.in_reserved = 0
+		self.in_shared = 0
+		# 等待连接的future，结果为分到的连接类型：'reserved'或'shared'
+		self.waiters = deque()
+		# 统计
+		self.acquired = 0
+		self.waited = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+	def has_waiters(self):
+		while self.waiters and self.waiters[0].done():
+			self.waiters.popleft()
+		return bool(self.waiters)
+
+	def stats(self):
+		return dict(reserved=self.reserved, weight=self.weight, in_use=self.in_reserved + self.in_shared,
+			waiting=sum(1 for f in self.waiters if not f.done()), acquired=self.acquired, waited=self.waited,
+			wait_avg_ms=(self.wait_total / self.waited * 1000 if self.waited else 0.0), wait_max_ms=self.wait_max * 1000)
+
+# 包装aiomysql的连接池，按通道限制同时取出的连接数；接口与aiomysql.Pool的get()一致
+# lanes: {'interactive': {'reserved': 4, 'weight': 4}, 'admin': {...}, ...}
+class PriorityPool(object):
+	def __init__(self, pool, lanes):
+		self._pool = pool
+		self.maxsize = pool.maxsize
+		self._lanes = dict()
+		for name, conf in lanes.items():
+			self._lanes[name] = _Lane(name, conf.get('reserved', 0), conf.get('weight', 1))
+		if DEFAULT_LANE not in self._lanes:
+			self._lanes[DEFAULT_LANE] = _Lane(DEFAULT_LANE)
+		reserved = sum(l.reserved for l in self._lanes.values())
+		if reserved > self.maxsize:
+			raise ValueError('Reserved connections (%s) exceed pool maxsize (%s)' % (reserved, self.maxsize))
+		self._shared_free = self.maxsize - reserved
+		# 加权轮询的顺序，权重高的通道出现的次数多
+		lanes = sorted(self._lanes.values(), key=lambda l: -l.weight)
+		self._schedule = [l for i in range(max(l.weight for l in lanes)) for l in lanes if l.weight > i]
+		self._turn = 0
+
+	@property
+	def size(self):
+		return self._pool.size
+
+	@property
+	def freesize(self):
+		return self._pool.freesize
+
+	def _get_lane(self):
+		name = _lane.get()
+		l = self._lanes.get(name, None)
+		if l is None:
+			l = self._lanes[DEFAULT_LANE]
+		return l
+
+	def _waiting(self):
+		return any(l.has_waiters() for l in self._lanes.values())
+
+	async def _admit(self, l):
+		if l.in_reserved < l.reserved:
+			l.in_reserved += 1
+			l.acquired += 1
+			return 'reserved'
+		# 有其它通道在排队时不插队
+		if self._shared_free > 0 and not self._waiting():
+			self._shared_free -= 1
+			l.in_shared += 1
+			l.acquired += 1
+			return 'shared'
+		fut = asyncio.get_event_loop().create_future()
+		l.waiters.append(fut)
+		start = time.time()
+		try:
+			kind = await fut
+		except asyncio.CancelledError:
+			# 已分到连接时还回去
+			if fut.done() and not fut.cancelled():
+				self._release(l, fut.result())
+			raise
+		wait = time.time() - start
+		l.acquired += 1
+		l.waited += 1
+		l.wait_total += wait
+		l.wait_max = max(l.wait_max, wait)
+		return kind
+
+	def _release(self, l, kind):
+		if kind == 'reserved':
+			# 预留连接只能给本通道的等待者
+			if l.has_waiters():
+				l.waiters.popleft().set_result('reserved')
+			else:
+				l.in_reserved -= 1
+			return
+		l.in_shared -= 1
+		for i in range(len(self._schedule)):
+			nxt = self._schedule[self._turn]
+			self._turn = (self._turn + 1) % len(self._schedule)
+			if nxt.has_waiters():
+				nxt.in_shared += 1
+				nxt.waiters.popleft().set_result('shared')
+				return
+		self._shared_free += 1
+
+	@contextlib.asynccontextmanager
+	async def get(self):
+		l = self._get_lane()
+		kind = await self._admit(l)
+		try:
+			conn = await self._pool.acquire()
+		except BaseException:
+			self._release(l, kind)
+			raise
+		try:
+			yield conn
+		finally:
+			self._pool.release(conn)
+			self._release(l, kind)
+
+	def close(self):
+		self._pool.close()
+
+	async def wait_closed(self):
+		await self._pool.wait_closed()
+
+	# 各通道的使用情况和排队等待时间
+	def stats(self):
+		return dict((name, l.stats()) for name, l in self._lanes.items())
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# 根据Model的__mappings__和索引定义生成建表/建索引的DDL，并与数据库中的表结构比较生成迁移语句
+# 用法：
+# python schema.py            输出建表语句
+# python schema.py --diff     连接数据库，输出需要执行的迁移语句
+# python schema.py --apply    连接数据库，执行迁移语句
+# 语法差异和读取表结构的方式由数据库后端提供(mysql_backend、sqlite_backend)
+
+import asyncio, logging, sys
+import orm
+
+# 生成建表语句
+def create_table_sql(model):
+	lines = []
+	for name in [model.__primary_key__] + model.__fields__:
+		field = model.__mappings__[name]
+		lines.append('`%s` %s%s' % (name, field.ddl, ' not null' if field.primary_key else ''))
+	lines.append('primary key (`%s`)' % model.__primary_key__)
+	return 'create table `%s` (\n\t%s\n)%s' % (model.__table__, ',\n\t'.join(lines), orm.backend().table_options)
+
+def _create_index_sql(model, name, columns, unique):
+	return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if unique else '', name, model.__table__, ','.join('`%s`' % c for c in columns))
+
+# 生成该表所有索引的建索引语句
+def create_index_sql(model):
+	return [_create_index_sql(model, name, columns, unique) for name, columns, unique in model.__index_defs__]
+
+# 生成完整的建表DDL
+def create_sql(*models):
+	statements = []
+	for model in models:
+		statements.append(create_table_sql(model))
+		statements.extend(create_index_sql(model))
+	return statements
+
+# MySQL中显示的类型名与DDL中写法不同的类型(SQLite显示DDL中的写法)
+_TYPE_ALIASES = {'real': 'double', 'boolean': 'tinyint', 'bool': 'tinyint'}
+
+def _type_names(ddl):
+	name = ddl.lower().split('(')[0].strip()
+	return (name, _TYPE_ALIASES.get(name, name))
+
+# 与数据库中的表结构比较，生成迁移语句：建缺失的表、加缺失的列和索引
+# drop为True时同时删除未声明的索引(主键除外)；列类型的差异只记录日志，不自动修改
+async def diff(model, drop=False):
+	backend = orm.backend()
+	columns = await backend.live_columns(model.__table__)
+	if columns is None:
+		return [create_table_sql(model)] + create_index_sql(model)
+	statements = []
+	previous = model.__primary_key__
+	for name in model.__fields__:
+		field = model.__mappings__[name]
+		if name not in columns:
+			statements.append(backend.add_column_sql(model.__table__, name, field.ddl, previous))
+		elif not columns[name].lower().startswith(_type_names(field.ddl)):
+			logging.info('column type differs: %s.%s %s (declared %s)' % (model.__table__, name, columns[name], field.ddl))
+		previous = name
+	live = await backend.live_indexes(model.__table__)
+	# 按列和唯一性比较，不要求索引名相同
+	existing = set(live.values())
+	declared = set()
+	for name, cols, unique in model.__index_defs__:
+		declared.add((cols, unique))
+		if (cols, unique) not in existing:
+			statements.append(_create_index_sql(model, name, cols, unique))
+	if drop:
+		for name, index in live.items():
+			if name != 'PRIMARY' and index not in declared:
+				statements.append(backend.drop_index_sql(model.__table__, name))
+	return statements
+
+# 生成(并执行)所有表的迁移语句
+async def migrate(*models, apply=False, drop=False):
+	statements = []
+	for model in models:
+		statements.extend(await diff(model, drop))
+	if apply:
+		for sql in statements:
+			await orm.execute(sql, [])
+	return statements
+
+
+if __name__ == '__main__':
+	from config import configs
+	from models import User, Blog, Comment
+	models = (User, Blog, Comment)
+	if '--diff' in sys.argv or '--apply' in sys.argv:
+		async def main(loop):
+			await orm.create_pool(loop, **configs['db'])
+			for sql in await migrate(*models, apply='--apply' in sys.argv, drop='--drop' in sys.argv):
+				print(sql + ';')
+		loop = asyncio.get_event_loop()
+		loop.run_until_complete(main(loop))
+	else:
+		orm.use_backend(configs['db'].get('backend', 'mysql'))
+		for sql in create_sql(*models):
+			print(sql + ';')
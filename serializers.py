@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# JSON序列化：按类型注册转换函数，把对象转换为可以直接序列化的dict/list/值，直接输出utf-8编码的bytes
+# 安装了orjson时使用orjson(C实现，直接生成bytes)，否则使用标准库json
+# Model是dict的子类，两种实现都按dict原生序列化，不经过转换函数；
+# Row按类预先生成转换函数，Page直接返回属性字典，其它对象退回到原来的obj.__dict__
+# 性能测试：python serializers.py [次数]
+
+import datetime, decimal, json, logging, operator
+from orm import Row
+from apis import Page
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+# 类型 ==> 转换函数，对该类型及其子类都有效
+_encoders = dict()
+# 类型 ==> 生成该类型转换函数的函数，用于每个子类结构不同的类型(如各个Row类)
+_compilers = dict()
+# 具体类型 ==> 查找到的转换函数
+_resolved = dict()
+
+def register(cls, encoder):
+	_encoders[cls] = encoder
+	_resolved.clear()
+
+def register_compiler(cls, compile):
+	_compilers[cls] = compile
+	_resolved.clear()
+
+def _resolve(tp):
+	for base in tp.__mro__:
+		if base in _encoders:
+			return _encoders[base]
+		if base in _compilers:
+			return _compilers[base](tp)
+	return _fallback
+
+def _fallback(obj):
+	try:
+		return obj.__dict__
+	except AttributeError:
+		raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+# 序列化遇到不支持的对象时调用，每个具体类型只查找一次转换函数
+def _default(obj):
+	tp = type(obj)
+	encoder = _resolved.get(tp, None)
+	if encoder is None:
+		encoder = _resolved[tp] = _resolve(tp)
+	return encoder(obj)
+
+# 按Row类的字段生成转换函数，用attrgetter一次取出所有字段
+def _compile_row(cls):
+	fields = cls._fields
+	if len(fields) == 1:
+		getter = operator.attrgetter(fields[0])
+		return lambda r: {fields[0]: getter(r)}
+	getter = operator.attrgetter(*fields)
+	return lambda r: dict(zip(fields, getter(r)))
+
+register_compiler(Row, _compile_row)
+register(Page, vars)
+register(decimal.Decimal, float)
+register(datetime.datetime, datetime.datetime.isoformat)
+register(datetime.date, datetime.date.isoformat)
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+def _dumps_json(obj):
+	return _json_encoder.encode(obj).encode('utf-8')
+
+def _dumps_orjson(obj):
+	return orjson.dumps(obj, default=_default)
+
+_BACKENDS = {'json': _dumps_json}
+if orjson is not None:
+	_BACKENDS['orjson'] = _dumps_orjson
+
+# 当前使用的实现
+dumps = _dumps_orjson if orjson is not None else _dumps_json
+
+# 选择实现：'orjson'、'json'或'auto'(有orjson时使用orjson)
+def use(name='auto'):
+	global dumps
+	if name == 'auto':
+		name = 'orjson' if orjson is not None else 'json'
+	if name not in _BACKENDS:
+		raise ValueError('JSON backend not available: %s' % name)
+	dumps = _BACKENDS[name]
+	logging.info('json backend: %s' % name)
+
+
+# 性能测试：/api/blogs一页的数据(Page + 10条紧凑Row，以及完整的Model)
+if __name__ == '__main__':
+	import sys, time
+	from models import Blog
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	blog = dict(id='0016178456789010001000001', user_id='0016178456789010001000000', user_name='maple', user_image='http://www.gravatar.com/avatar/1',
+		name='测试日志的标题', summary='这是一篇测试日志的摘要，长度和普通的摘要差不多。' * 2, created_at=1617845678.901)
+	row = Blog._row()
+	payloads = {
+		'rows': dict(page=Page(95, 3), blogs=[row(*[blog[c] for c in row._fields]) for i in range(10)]),
+		'models': dict(page=Page(95, 3), blogs=[Blog(**blog) for i in range(10)])
+	}
+	encoders = [('json.dumps + __dict__', lambda r: json.dumps(r, ensure_ascii=False, default=lambda obj: obj.__dict__).encode('utf-8'))]
+	encoders += [(name, fn) for name, fn in sorted(_BACKENDS.items())]
+	for label, payload in sorted(payloads.items()):
+		for name, fn in encoders:
+			size = len(fn(payload))
+			start = time.time()
+			for i in range(n):
+				fn(payload)
+			elapsed = time.time() - start
+			print('%-8s %-24s %8.1f us/op  %6d bytes' % (label, name, elapsed / n * 1e6, size))
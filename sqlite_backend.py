@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# coding:utf-8
+
+# SQLite后端：单机部署时不需要MySQL，查询在进程内完成，没有网络往返
+# 只有一个写连接，运行在专用线程上，所有写操作和connection()/transaction()作用域排队使用它
+# 另有readers个读连接，各自运行在自己的线程上，作为orm的只读副本使用
+# WAL模式下读写互不阻塞，写连接提交后读连接立即可见，所以不需要read_your_writes
+# ORM生成的sql(反引号、limit ?, ?、多行insert、保存点)SQLite都支持，占位符就是?
+# 配置：{'backend': 'sqlite', 'path': 'awesome.db', 'readers': 4}，path必须是文件(内存数据库不能在连接间共享)
+
+import asyncio, contextlib, logging, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import orm
+
+name = 'sqlite'
+placeholder = '?'
+multi_statements = False
+replica_lag = False
+explain = 'explain query plan '
+table_options = ''
+
+# 一个SQLite连接和它专用的线程，连接上的所有操作都在这个线程中执行
+class _Connection(object):
+	def __init__(self, loop, path, readonly=False, timeout=5):
+		self._loop = loop
+		self._path = path
+		self._readonly = readonly
+		self._timeout = timeout
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-%s' % ('reader' if readonly else 'writer'))
+		self._db = None
+
+	def _run(self, fn, *args):
+		return self._loop.run_in_executor(self._executor, fn, *args)
+
+	async def open(self):
+		await self._run(self._open)
+
+	def _open(self):
+		# isolation_level=None：自动提交，事务由begin()显式开启
+		db = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None)
+		if self._readonly:
+			db.execute('pragma query_only=1')
+		else:
+			db.execute('pragma journal_mode=wal')
+			# WAL模式下synchronous=normal在掉电时可能丢失最近的提交，但不会损坏数据库
+			db.execute('pragma synchronous=normal')
+		self._db = db
+
+	def cursor(self, cursor_class=None):
+		return (cursor_class or Cursor)(self)
+
+	async def begin(self):
+		# 写连接直接获取写锁，避免事务中途升级为写事务时失败
+		await self._run(self._db.execute, 'begin' if self._readonly else 'begin immediate')
+
+	async def commit(self):
+		await self._run(self._db.commit)
+
+	async def rollback(self):
+		await self._run(self._db.rollback)
+
+	def close(self):
+		if self._db is not None:
+			self._executor.submit(self._db.close)
+		self._executor.shutdown(wait=False)
+
+# 与aiomysql游标相同的接口，每行返回元组
+class Cursor(object):
+	def __init__(self, conn):
+		self._conn = conn
+		self._cur = None
+		self.rowcount = -1
+		self.description = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def execute(self, sql, args=None):
+		self._cur = await self._conn._run(self._conn._db.execute, sql, tuple(args or ()))
+		self.rowcount = self._cur.rowcount
+		self.description = self._cur.description
+
+	async def executemany(self, sql, args_list):
+		self._cur = await self._conn._run(self._conn._db.executemany, sql, [tuple(args) for args in args_list])
+		self.rowcount = self._cur.rowcount
+		self.description = self._cur.description
+
+	async def fetchall(self):
+		return self._convert(await self._conn._run(self._cur.fetchall))
+
+	async def fetchmany(self, size):
+		return self._convert(await self._conn._run(self._cur.fetchmany, size))
+
+	async def nextset(self):
+		return None
+
+	async def close(self):
+		if self._cur is not None:
+			await self._conn._run(self._cur.close)
+			self._cur = None
+
+	def _convert(self, rows):
+		return rows
+
+# 每行返回字典
+class DictCursor(Cursor):
+	def _convert(self, rows):
+		names = [d[0] for d in self.description]
+		return [dict(zip(names, r)) for r in rows]
+
+# SQLite的游标本身就是逐行读取的，流式查询直接使用DictCursor
+SSDictCursor = DictCursor
+
+# 连接池：与aiomysql.Pool的get()/acquire()/release()接口一致，连接在创建时全部打开
+class Pool(object):
+	def __init__(self, connections):
+		self._connections = connections
+		self._free = asyncio.Queue()
+		for conn in connections:
+			self._free.put_nowait(conn)
+		self.maxsize = len(connections)
+
+	@property
+	def size(self):
+		return self.maxsize
+
+	@property
+	def freesize(self):
+		return self._free.qsize()
+
+	async def acquire(self):
+		return await self._free.get()
+
+	def release(self, conn):
+		self._free.put_nowait(conn)
+
+	@contextlib.asynccontextmanager
+	async def get(self):
+		conn = await self.acquire()
+		try:
+			yield conn
+		finally:
+			self.release(conn)
+
+	def close(self):
+		for conn in self._connections:
+			conn.close()
+
+	async def wait_closed(self):
+		pass
+
+# 返回(写连接池, [读连接池])，先打开写连接，由它创建数据库文件并切换到WAL模式
+async def create_pools(loop, **kw):
+	loop = loop or asyncio.get_event_loop()
+	path = kw.get('path', 'awesome.db')
+	timeout = kw.get('timeout', 5)
+	logging.info('open sqlite database: %s' % path)
+	writer = _Connection(loop, path, False, timeout)
+	await writer.open()
+	readers = []
+	for i in range(kw.get('readers', 4)):
+		conn = _Connection(loop, path, True, timeout)
+		await conn.open()
+		readers.append(conn)
+	return Pool([writer]), [Pool(readers)] if readers else []
+
+# 使用pragma的表值函数而不是pragma语句：读连接上的pragma语句不会重新加载其它连接修改过的表结构
+async def live_columns(table):
+	rs = await orm.select('select name, type from pragma_table_info(?)', [table])
+	if not rs:
+		return None
+	return dict((r['name'], r['type']) for r in rs)
+
+# 主键的自动索引记为PRIMARY
+async def live_indexes(table):
+	indexes = dict()
+	for r in await orm.select('select name, "unique", origin from pragma_index_list(?)', [table]):
+		columns = tuple(c['name'] for c in await orm.select('select name from pragma_index_info(?) order by seqno', [r['name']]))
+		indexes['PRIMARY' if r['origin'] == 'pk' else r['name']] = (columns, bool(r['unique']))
+	return indexes
+
+# SQLite不支持指定新列的位置
+def add_column_sql(table, column, ddl, after):
+	return 'alter table `%s` add column `%s` %s' % (table, column, ddl)
+
+def drop_index_sql(table, index):
+	return 'drop index `%s`' % index
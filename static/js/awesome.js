@@ -118,9 +118,15 @@ function parseQueryString() {
     return r;
 }
 
-function gotoPage(i) {
+function gotoPage(i, cursor) {
     var r = parseQueryString();
     r.page = i;
+    if (cursor) {
+        r.cursor = cursor;
+    }
+    else {
+        delete r.cursor;
+    }
     location.assign('?' + $.param(r));
 }
 
@@ -347,6 +353,26 @@ function postJSON(url, data, callback) {
     _httpJSON('POST', url, data, callback);
 }
 
+// ajax upload FormData (multipart/form-data):
+
+function postFile(url, form, callback) {
+    $.ajax({
+        type: 'POST',
+        url: url,
+        data: form,
+        dataType: 'json',
+        processData: false,
+        contentType: false
+    }).done(function (r) {
+        if (r && r.error) {
+            return callback(r);
+        }
+        return callback(null, r);
+    }).fail(function (jqXHR, textStatus) {
+        return callback({'error': 'http_bad_response', 'data': '' + jqXHR.status, 'message': '网络好像出问题了 (HTTP ' + jqXHR.status + ')'});
+    });
+}
+
 // extends Vue:
 
 if (typeof(Vue)!=='undefined') {
@@ -360,10 +386,10 @@ if (typeof(Vue)!=='undefined') {
     Vue.component('pagination', {
         template: '<ul class="uk-pagination">' +
                 '<li v-if="! has_previous" class="uk-disabled"><span><i class="uk-icon-angle-double-left"></i></span></li>' +
-                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
+                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \',\\\'\' + (prev_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
                 '<li class="uk-active"><span v-text="page_index"></span></li>' +
                 '<li v-if="! has_next" class="uk-disabled"><span><i class="uk-icon-angle-double-right"></i></span></li>' +
-                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
+                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \',\\\'\' + (next_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
             '</ul>'
     });
 }